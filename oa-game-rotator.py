@@ -29,26 +29,395 @@
 # Import necessary libraries
 import argparse
 import os, datetime, time, sys
-import math, re
+import math, re, hashlib
+import select, signal, errno, calendar, struct
 import pprint # Unnecessary, used only for debugging purposes
 
 #***********************************
 #                   FUNCTIONS
 #***********************************
 
-# Redirect print output to the terminal as well as in a log file
-class Tee(object):
-    def __init__(self, name, mode):
-        self.file = open(name, mode)
-        self.stdout = sys.stdout
-        sys.stdout = self
-    def __del__(self):
-        sys.stdout = self.stdout
-        self.file.close()
+# Log file writer: each line is written as a JSON record ({"time", "stream", "message"}) in one shared file, through a buffer that a background thread writes every interval seconds (and on explicit flush, eg: at each transition and at exit)
+# The file is rotated when it gets bigger than maxsize bytes or older than maxage seconds (0 to disable), the rotated files are compressed with gzip and only the last keep ones are kept
+class LogWriter(object):
+    def __init__(self, path, maxsize = 10*1024*1024, maxage = 24*3600, keep = 10, interval = 5):
+        import threading
+        self.path = path
+        self.maxsize = maxsize
+        self.maxage = maxage
+        self.keep = keep
+        self.interval = interval
+        self.buffer = []
+        self.lock = threading.Lock() # protects the buffer and the file (the rotation replaces the file)
+        self.file = open(path, 'a')
+        self.opened = time.time()
+        self.closed = threading.Event()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    # Add a record to the buffer, tags are added as fields of the record (eg: the slot of a command's output)
+    # The output of the commands may be in any encoding, so the strings are decoded as UTF-8 with the invalid bytes replaced, and a record that still can't be written is dropped: logging must never stop the rotator
+    def append(self, stream, message, tags = None):
+        import json
+        try:
+            record = {'time': datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.%fZ"), 'stream': stream, 'message': message}
+            if tags:
+                record.update(tags)
+            for key, value in record.items():
+                if isinstance(value, bytes):
+                    record[key] = value.decode('utf-8', 'replace')
+            record = json.dumps(record)
+        except Exception as inst:
+            sys.__stderr__.write('ERROR: a record could not be written in the log '+self.path+'. Error: '+str(inst)+'\n')
+            return
+        with self.lock:
+            self.buffer.append(record)
+
+    # Write the buffer to the file (if it can't be written, eg: disk full, the records are dropped so that the memory stays bounded)
+    def flush(self):
+        with self.lock:
+            try:
+                if self.buffer:
+                    self.file.write('\n'.join(self.buffer) + '\n')
+                self.file.flush()
+            except (IOError, OSError, ValueError) as inst: # ValueError: the file is closed
+                sys.__stderr__.write('ERROR: the log could not be written in '+self.path+', '+str(len(self.buffer))+' records are lost. Error: '+str(inst)+'\n')
+            self.buffer = []
+
+    def close(self):
+        self.closed.set()
+        self.thread.join(self.interval + 1)
+        self.flush()
+        with self.lock:
+            self.file.close()
+
+    # Background thread: write the buffer regularly, and rotate the file if needed (so that the compression is not done in the main thread)
+    def run(self):
+        while not self.closed.wait(self.interval):
+            try:
+                self.flush()
+                if self.file.tell() > self.maxsize or (self.maxage and time.time() - self.opened > self.maxage):
+                    self.rotate()
+            except (IOError, OSError) as inst:
+                sys.__stderr__.write('ERROR: the log could not be written in '+self.path+'. Error: '+str(inst)+'\n')
+
+    def rotate(self):
+        import gzip, shutil, glob
+        rotatedpath = self.path + '.' + datetime.datetime.utcnow().strftime("%Y%m%d-%H%M%S")
+        with self.lock:
+            self.file.close()
+            os.rename(self.path, rotatedpath)
+            self.file = open(self.path, 'a')
+            self.opened = time.time()
+        # Compress the rotated file, then remove the oldest ones
+        source = open(rotatedpath, 'rb')
+        target = gzip.open(rotatedpath + '.gz', 'wb')
+        shutil.copyfileobj(source, target)
+        target.close()
+        source.close()
+        os.remove(rotatedpath)
+        for oldpath in sorted(glob.glob(self.path + '.*.gz'))[:-self.keep]:
+            os.remove(oldpath)
+
+# Redirect print output to the terminal as well as in the log file (see LogWriter), each line being a record of the given stream (stdout or stderr)
+class LogStream(object):
+    def __init__(self, writer, stream, terminal):
+        self.writer = writer
+        self.stream = stream
+        self.terminal = terminal
+        self.partial = '' # beginning of the current line, written with the rest of the line
     def write(self, data):
-        self.file.write(data)
-        self.file.flush()
-        self.stdout.write(data)
+        self.terminal.write(data)
+        lines = (self.partial + data).split('\n')
+        self.partial = lines.pop()
+        for line in lines:
+            self.writer.append(self.stream, line)
+    def flush(self):
+        self.terminal.flush()
+
+logwriter = None # log file of the rotator, if any (see main)
+
+# Metrics of the rotator's internals (counters, gauges and histograms, with labels), rendered in the Prometheus text format by the MetricsExporter
+# Updating a metric only changes a number in memory, the rendering and writing are done later in batch, so it can be called anywhere
+class Metrics(object):
+    def __init__(self):
+        self.metrics = dict() # name -> {'type', 'help', 'buckets', 'values': {labels: value}}
+        self.order = [] # names in declaration order
+        self.dirty = False # updated since the last export?
+
+    def declare(self, name, metrictype, help, buckets = None):
+        self.metrics[name] = {'type': metrictype, 'help': help, 'buckets': buckets, 'values': dict()}
+        self.order.append(name)
+
+    def inc(self, name, value = 1, **labels):
+        values = self.metrics[name]['values']
+        key = tuple(sorted(labels.items()))
+        values[key] = values.get(key, 0) + value
+        self.dirty = True
+
+    def set(self, name, value, **labels):
+        self.metrics[name]['values'][tuple(sorted(labels.items()))] = value
+        self.dirty = True
+
+    def observe(self, name, value, **labels):
+        metric = self.metrics[name]
+        key = tuple(sorted(labels.items()))
+        if key not in metric['values']:
+            metric['values'][key] = {'buckets': [0] * len(metric['buckets']), 'sum': 0.0, 'count': 0}
+        histogram = metric['values'][key]
+        for i, bound in enumerate(metric['buckets']):
+            if value <= bound:
+                histogram['buckets'][i] += 1
+                break
+        histogram['sum'] += value
+        histogram['count'] += 1
+        self.dirty = True
+
+    # Render all the metrics in the Prometheus text format
+    def render(self):
+        def labelstring(key, extra = ()):
+            pairs = list(key) + list(extra)
+            if not pairs:
+                return ''
+            return '{' + ','.join([k + '="' + str(v).replace('\\', '\\\\').replace('"', '\\"') + '"' for k, v in pairs]) + '}'
+        lines = []
+        for name in self.order:
+            metric = self.metrics[name]
+            lines.append('# HELP ' + name + ' ' + metric['help'])
+            lines.append('# TYPE ' + name + ' ' + metric['type'])
+            for key, value in sorted(metric['values'].items()):
+                if metric['type'] == 'histogram':
+                    cumulated = 0
+                    for bound, count in zip(metric['buckets'], value['buckets']):
+                        cumulated += count
+                        lines.append(name + '_bucket' + labelstring(key, [('le', repr(float(bound)))]) + ' ' + str(cumulated))
+                    lines.append(name + '_bucket' + labelstring(key, [('le', '+Inf')]) + ' ' + str(value['count']))
+                    lines.append(name + '_sum' + labelstring(key) + ' ' + repr(float(value['sum'])))
+                    lines.append(name + '_count' + labelstring(key) + ' ' + str(value['count']))
+                else:
+                    lines.append(name + labelstring(key) + ' ' + repr(float(value)))
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
+metrics.declare('oagamerotator_transition_lateness_seconds', 'histogram', 'Time between the planned and the actual start of the transitions.', [0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300])
+metrics.declare('oagamerotator_command_duration_seconds', 'histogram', 'Duration of the shell commands (oamps.sh calls).', [0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300])
+metrics.declare('oagamerotator_command_exit_total', 'counter', 'Shell commands by exit code.')
+metrics.declare('oagamerotator_downloads_total', 'counter', 'Downloads of the slotsfile by result (success, not_modified, failure).')
+metrics.declare('oagamerotator_download_duration_seconds', 'histogram', 'Duration of the downloads of the slotsfile.', [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10])
+metrics.declare('oagamerotator_slotsfile_parse_total', 'counter', 'Reads of the slotsfile by result of the parse cache (hit, miss).')
+metrics.declare('oagamerotator_current_slot', 'gauge', 'Index of the slot applied last (-1 in idle mode).')
+metrics.declare('oagamerotator_next_deadline_timestamp_seconds', 'gauge', 'Time of the next planned transition (unix timestamp).')
+
+# Export the metrics: a textfile for the textfile collector of node_exporter (written atomically every interval seconds, only if the metrics changed), and/or a local HTTP endpoint, both served from the eventloop so that they are never on the way of a transition
+class MetricsExporter(object):
+    def __init__(self, eventloop, metrics, path = None, port = None, interval = 10):
+        self.metrics = metrics
+        self.path = path
+        if path:
+            eventloop.add_timer(interval, self.write, delay=0)
+        if port:
+            import BaseHTTPServer
+            exporter = self
+            class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+                timeout = 2 # a slow client must not block the loop
+                def do_GET(self):
+                    body = exporter.metrics.render()
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                def log_message(self, format, *args): # no log for each scrape
+                    pass
+            self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', port), MetricsHandler)
+            eventloop.add_reader(self.server.socket, lambda fd: self.server.handle_request())
+
+    def write(self):
+        if not self.metrics.dirty:
+            return
+        self.metrics.dirty = False
+        try:
+            f = open(self.path + '.tmp', 'w')
+            f.write(self.metrics.render())
+            f.close()
+            os.rename(self.path + '.tmp', self.path) # the collector never reads a half written file
+        except (IOError, OSError) as inst:
+            print('ERROR: the metrics could not be written in '+self.path+'. Error: '+str(inst))
+
+# Webhook receiver: a small HTTP listener where the booking manager can notify that the bookings of a server changed (eg: POST /notify with {"server": "X", "date": "2014-03-20"}, as JSON, form or query string), so that the slotsfile is downloaded and the plan recompiled right away instead of at the next poll
+# The notifications for another server, or for a date whose slotsfile is not the one in use today, are ignored. If token is set, the notification must carry it (token parameter or X-Token header)
+class WebhookServer(object):
+    def __init__(self, eventloop, servername, port, address = '127.0.0.1', token = None):
+        import BaseHTTPServer
+        self.eventloop = eventloop
+        self.servername = servername
+        self.token = token
+        receiver = self
+        class WebhookHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+            timeout = 2 # a slow client must not block the loop
+            def do_GET(self):
+                self.answer(receiver.notify(self.path, '', self.headers))
+            def do_POST(self):
+                try:
+                    length = min(int(self.headers.get('Content-Length', 0)), 65536)
+                except ValueError:
+                    length = 0
+                self.answer(receiver.notify(self.path, self.rfile.read(length), self.headers))
+            def answer(self, result):
+                import json
+                [code, body] = result
+                body = json.dumps(body)+'\n'
+                self.send_response(code)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            def log_message(self, format, *args):
+                pass
+        self.server = BaseHTTPServer.HTTPServer((address, port), WebhookHandler)
+        eventloop.add_reader(self.server.socket, lambda fd: self.server.handle_request())
+
+    # Handle a notification, returns [HTTP code, answer]
+    def notify(self, path, body, headers):
+        import urlparse, json
+        params = dict([(key, values[0]) for key, values in urlparse.parse_qs(urlparse.urlparse(path).query).items()])
+        if body.strip().startswith('{'):
+            try:
+                params.update(json.loads(body))
+            except ValueError:
+                return [400, {'ok': False, 'error': 'invalid JSON'}]
+        elif body:
+            params.update(dict([(key, values[0]) for key, values in urlparse.parse_qs(body).items()]))
+        if self.token and self.token not in [params.get('token'), headers.get('X-Token')]:
+            return [403, {'ok': False, 'error': 'invalid token'}]
+        if params.get('server') and params['server'] != self.servername:
+            return [200, {'ok': True, 'reload': False, 'reason': 'not this server'}]
+        # the slotsfiles used today are the one of the day, the month, the year, or the server (see get_slotsfilename)
+        if params.get('date') and not datetime.datetime.utcnow().strftime("%Y-%m-%d").startswith(str(params['date'])):
+            return [200, {'ok': True, 'reload': False, 'reason': 'not today'}]
+        print('Webhook: the bookings changed, downloading the slotsfile now.')
+        self.eventloop.interrupt('reload') # several notifications before the reload make only one reload
+        return [200, {'ok': True, 'reload': True}]
+
+# Status board shared by all the rotators of a host: a memory-mapped file with a header and a fixed number of fixed-size records, one per rotator (claimed by server name), so that a dashboard (see board_main) can read the state of all the servers at once without asking anything to the rotators
+# Each rotator only writes its own record, with a seqlock: the sequence number is odd while the record is being written, so a reader retries if it reads an odd or changed sequence number
+# Record: sequence number, pid, server name, slot (-1 for none), kind of the last transition, next deadline, last update, lateness of the last transition (seconds), health flags (see board_flags)
+board_magic = 'OAGRBRD1'
+board_header = struct.Struct('<8sII') # magic, number of records, size of a record
+board_record = struct.Struct('<Ii32si8sdddI')
+board_recordsize = 128 # room for new fields
+board_flags = ['idle', 'paused', 'unreachable', 'commandfailed', 'supervisorgaveup', 'stopped']
+
+class StatusBoard(object):
+    def __init__(self, path, name, nbrecords = 64):
+        import mmap, fcntl
+        self.name = name[:32]
+        f = open(path, 'a+b')
+        fcntl.lockf(f, fcntl.LOCK_EX) # only one rotator at a time creates the file or claims a record
+        try:
+            f.seek(0, os.SEEK_END)
+            if f.tell() == 0:
+                f.write(board_header.pack(board_magic, nbrecords, board_recordsize).ljust(board_recordsize, '\0') + '\0' * board_recordsize * nbrecords)
+                f.flush()
+            self.mmap = mmap.mmap(f.fileno(), 0)
+            [magic, self.nbrecords, recordsize] = board_header.unpack_from(self.mmap, 0)
+            if magic != board_magic or recordsize != board_recordsize:
+                raise IOError('this is not a status board of this version of the rotator')
+            self.offset = self.claim()
+            self.seq = board_record.unpack_from(self.mmap, self.offset)[0] & ~1
+            self.fields = {'slot': -1, 'kind': '', 'deadline': 0.0, 'lateness': 0.0, 'flags': 0}
+            self.update() # write the name before releasing the lock, so that no other rotator claims the same record
+        finally:
+            fcntl.lockf(f, fcntl.LOCK_UN)
+            f.close() # the mapping stays valid
+
+    # Offset of the record of this server: the one with its name, else a free one, else the one of a rotator that is not running anymore
+    def claim(self):
+        free = None
+        for i in range(self.nbrecords):
+            offset = board_recordsize * (i + 1)
+            [seq, pid, name] = board_record.unpack_from(self.mmap, offset)[:3]
+            name = name.rstrip('\0')
+            if name == self.name:
+                return offset
+            if free is None and (not name or not pid_alive(pid)):
+                free = offset
+        if free is None:
+            raise IOError('all the '+str(self.nbrecords)+' records are used by running rotators')
+        return free
+
+    # Update some fields of the record (see board_record), flags being a list of names from board_flags
+    def update(self, **fields):
+        if 'flags' in fields:
+            fields['flags'] = sum([1 << board_flags.index(flag) for flag in fields['flags']])
+        self.fields.update(fields)
+        record = board_record.pack(0, os.getpid(), self.name, self.fields['slot'], self.fields['kind'][:8], self.fields['deadline'], time.time(), self.fields['lateness'], self.fields['flags'])[4:]
+        self.seq += 1 # odd: being written
+        struct.pack_into('<I', self.mmap, self.offset, self.seq & 0xffffffff)
+        self.mmap[self.offset+4:self.offset+board_record.size] = record
+        self.seq += 1
+        struct.pack_into('<I', self.mmap, self.offset, self.seq & 0xffffffff)
+
+# Publish the state of the rotator in the status board (see StatusBoard): the health flags are computed from the current state, fields are the other fields to update (eg: the slot after a transition)
+def publish_board(board, idle, lastexits, control = None, healthcheck = None, supervisor = None, **fields):
+    flags = []
+    if idle:
+        flags.append('idle')
+    if control is not None and control.paused:
+        flags.append('paused')
+    if healthcheck is not None and healthcheck.health is not None and healthcheck.failures > 0:
+        flags.append('unreachable')
+    if [code for code in lastexits if code != 0]: # failed or timed out (None)
+        flags.append('commandfailed')
+    if supervisor is not None and supervisor.processes.get('game', {}).get('failed'):
+        flags.append('supervisorgaveup')
+    board.update(flags=flags, **fields)
+
+# Is a process running?
+def pid_alive(pid):
+    if pid <= 0:
+        return False
+    try:
+        os.kill(pid, 0)
+    except OSError as inst:
+        return inst.errno == errno.EPERM # running, but as another user
+    return True
+
+# Read all the records of a status board (see StatusBoard), as a list of dicts (the free records are skipped)
+# A record still being written after all the retries (eg: its rotator was killed in the middle of an update) has the flag 'inconsistent', its values may be torn
+def read_status_board(path, retries = 10):
+    import mmap
+    f = open(path, 'rb')
+    board = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    f.close()
+    [magic, nbrecords, recordsize] = board_header.unpack_from(board, 0)
+    if magic != board_magic or recordsize != board_recordsize:
+        raise IOError('this is not a status board of this version of the rotator')
+    data = board[:] # one read for all the records
+    records = []
+    for i in range(nbrecords):
+        offset = board_recordsize * (i + 1)
+        consistent = False
+        for retry in range(retries):
+            values = board_record.unpack_from(data, offset)
+            if values[0] % 2 == 0 and struct.unpack_from('<I', board, offset)[0] == values[0]: # consistent: not being written, and not changed since the copy
+                consistent = True
+                break
+            time.sleep(0.001)
+            data = data[:offset] + board[offset:offset+board_recordsize] + data[offset+board_recordsize:] # read this record again
+        [seq, pid, name, slot, kind, deadline, updated, lateness, flags] = values
+        name = name.rstrip('\0')
+        if not name:
+            continue
+        flags = [flag for bit, flag in enumerate(board_flags) if flags & (1 << bit)]
+        if not pid_alive(pid) and 'stopped' not in flags:
+            flags.append('stopped')
+        if not consistent:
+            flags.append('inconsistent')
+        records.append({'name': name, 'pid': pid, 'slot': slot if slot >= 0 else None, 'kind': kind.rstrip('\0'), 'deadline': deadline or None, 'updated': updated, 'lateness': lateness, 'flags': flags})
+    board.close()
+    return records
 
 # UNUSED: for argparse to return a fullpath (absolute) instead of a relative path
 class FullPaths(argparse.Action):
@@ -175,6 +544,26 @@ def read_slotsfile(slotsfolder, servername, delimiter, assign):
     else:
         return None # If none was found, we return None (meaning we have no booking at all)
 
+    # Parse cache: the slotsfile is only parsed again if it changed (the returned slots must not be modified)
+    global slotsfile_cache
+    try:
+        stat = os.stat(slotsfilename)
+        cachekey = (slotsfilename, stat.st_mtime, stat.st_size, delimiter, assign)
+    except OSError:
+        cachekey = None
+    if cachekey is not None and slotsfile_cache is not None and slotsfile_cache[0] == cachekey:
+        metrics.inc('oagamerotator_slotsfile_parse_total', result='hit')
+        return slotsfile_cache[1]
+    metrics.inc('oagamerotator_slotsfile_parse_total', result='miss')
+    result = parse_slotsfile(slotsfilename, delimiter, assign)
+    slotsfile_cache = (cachekey, result)
+    return result
+
+# Cache of the last parsed slotsfile: ((path, modification time, size, delimiter, assign), result of parse_slotsfile)
+slotsfile_cache = None
+
+# Parse a slotsfile and return the total number of slots and the list of slots (see read_slotsfile), or None if it's empty or invalid
+def parse_slotsfile(slotsfilename, delimiter, assign):
     # Read the slotsfile
     slotsfile = open(slotsfilename, 'r')
 
@@ -240,18 +629,41 @@ def get_today(timedelimiter=":", margindelay = 0):
 def get_slotsfilename(start_date, slotsfolder, servername):
     return os.path.join(slotsfolder,servername+'-'+start_date+'.txt')
 
+# Validators (ETag, Last-Modified) of the downloaded slotsfiles, by local path
+slotsfile_validators = dict()
+
 # Remotely download a slot file (containing the booking data, see jobs/ folder for a dummy file)
+# The download is conditional: if the server gave an ETag or a Last-Modified date for the file we have, it only sends it again if it changed (else it answers 304 Not Modified and the local file is kept)
 def download_slotsfile(slotsfolder, servername, start_date, download_url, download_password):
     import urllib2
+    start = time.time()
+    slotsfilepath = get_slotsfilename(start_date, slotsfolder, servername)
     try:
         download_fullurl = download_url+'?server_name='+servername+'&password='+download_password+'&start_date='+start_date
         print("Downloading slotsfile from: "+download_fullurl)
         # Download the slots file
-        response = urllib2.urlopen(download_fullurl, timeout=10)
+        request = urllib2.Request(download_fullurl)
+        validators = slotsfile_validators.get(slotsfilepath)
+        if validators is not None and os.path.exists(slotsfilepath): # conditional request, only if we still have the file
+            if validators[0]:
+                request.add_header('If-None-Match', validators[0])
+            if validators[1]:
+                request.add_header('If-Modified-Since', validators[1])
+        try:
+            response = urllib2.urlopen(request, timeout=10)
+        except urllib2.HTTPError as inst:
+            if inst.code != 304:
+                raise
+            print('The slotsfile did not change since the last download.')
+            metrics.inc('oagamerotator_downloads_total', result='not_modified')
+            metrics.observe('oagamerotator_download_duration_seconds', time.time() - start)
+            return
+        slotsfile_validators[slotsfilepath] = (response.info().getheader('ETag'), response.info().getheader('Last-Modified'))
         slots = response.read() # store the file in a list
         response.close() # close the remote file
+        metrics.inc('oagamerotator_downloads_total', result='success')
+        metrics.observe('oagamerotator_download_duration_seconds', time.time() - start)
         # Save the remote slots file into a local slots file
-        slotsfilepath = get_slotsfilename(start_date, slotsfolder, servername)
         f = open(slotsfilepath, 'w')
         f.write(slots)
         f.flush() # refresh the file (so that the lines get written in, close() do the same)
@@ -259,6 +671,8 @@ def download_slotsfile(slotsfolder, servername, start_date, download_url, downlo
         slots = None # delete the temporary list
     # If there's an error (probably because we can't download the file)
     except Exception as inst:
+        metrics.inc('oagamerotator_downloads_total', result='failure')
+        metrics.observe('oagamerotator_download_duration_seconds', time.time() - start)
         # If we tried to download today's slotsfile, we show a different message error (more significant for debugging)
         [d, today, currtime] = get_today()
         if (start_date == today):
@@ -312,28 +726,545 @@ def slotwait(nbslots, timedelimiter = ":", margindelay = 0):
         time.sleep(60)
     return
 
-# Outputs a string of commands to reconnect a gtv server
-def gtv_reconnect(servport, servaddr = "localhost", password = ''):
+# Get a signature of the slotsfiles that may be loaded for the server (folder's modification time plus today's, month's and year's slotsfiles modification times)
+# if the signature changes, then a slotsfile was created, removed or modified
+def get_slotsfiles_signature(slotsfolder, servername):
+    d = datetime.datetime.utcnow()
+    signature = []
+    for path in [slotsfolder,
+                 os.path.join(slotsfolder,servername+'-'+d.strftime("%Y-%m-%d")+'.txt'),
+                 os.path.join(slotsfolder,servername+'-'+d.strftime("%Y-%m")+'.txt'),
+                 os.path.join(slotsfolder,servername+'-'+d.strftime("%Y")+'.txt')]:
+        try:
+            signature.append(os.stat(path).st_mtime)
+        except OSError: # the file does not exist (yet)
+            signature.append(None)
+    return signature
+
+# Wait (when there's no slotsfile, in idle mode) until the next check, but awake earlier if a slotsfile appears or changes in the slots folder
+# this is the same as slotwait(), except that the slots folder is watched every watchinterval seconds meanwhile (a simple os.stat(), so it does not cost anything)
+# If an eventloop is given, it runs meanwhile (instead of just sleeping)
+def idlewait(nbslots, slotsfolder, servername, timedelimiter = ":", margindelay = 0, watchinterval = 10, eventloop = None):
+    [currslot, nextslot, nexttime, nexttimestr, sleeptime] = get_slots_time_infos(nbslots, timedelimiter, margindelay)
+    print('Sleeping until next check at '+nexttimestr+' UTC (or earlier if a slotsfile appears in '+slotsfolder+')')
+    signature = get_slotsfiles_signature(slotsfolder, servername)
+    waketime = nexttime+datetime.timedelta(seconds=margindelay)
+    while (datetime.datetime.utcnow() < waketime):
+        remaining = waketime - datetime.datetime.utcnow()
+        if eventloop is not None:
+            eventloop.run_until(time.time() + max(1, min(watchinterval, remaining.seconds+1)))
+            if eventloop.interrupted:
+                return True
+        else:
+            time.sleep(max(1, min(watchinterval, remaining.seconds+1)))
+        if get_slotsfiles_signature(slotsfolder, servername) != signature:
+            print('A slotsfile was changed in the slots folder, checking it now.')
+            return True
+    return False
+
+# Send a connectionless packet to a Quake 3 server (or GTV server) and return the list of the payloads of the responses (or None if there was no response)
+# This is used for status queries and rcon commands. A response can be split in several packets (eg: long rcon outputs), so we read until no more packet arrives
+def q3_request(host, port, request, timeout = 1.0, multipacket = True):
+    import socket
+    responses = []
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        sock.settimeout(timeout)
+        sock.sendto('\xff\xff\xff\xff'+request+'\n', (host, int(port)))
+        while 1:
+            try:
+                data = sock.recv(65536)
+            except socket.timeout:
+                break
+            if data.startswith('\xff\xff\xff\xff'):
+                data = data[4:]
+            responses.append(data)
+            if not multipacket:
+                break
+            sock.settimeout(0.2) # the next packets of a split response arrive right after the first one
+    except socket.error: # eg: connection refused because the server is down
+        return None
+    finally:
+        sock.close()
+    if not responses:
+        return None
+    return responses
+
+# Send a rcon command to a Quake 3 server (or GTV server) and return its console output (or None if the server did not answer)
+def q3_rcon(host, port, password, command, timeout = 1.0):
+    responses = q3_request(host, port, 'rcon "'+password+'" '+command, timeout)
+    if responses is None:
+        return None
+    output = ''
+    for response in responses:
+        if response.startswith('print\n'):
+            response = response[len('print\n'):]
+        output += response
+    return output
+
+# Query the status of a Quake 3 server (getstatus): returns a dict with the server's cvars plus a 'players' list (each player being a dict with score, ping and name), or None if the server did not answer
+def q3_getstatus(host, port, timeout = 1.0):
+    responses = q3_request(host, port, 'getstatus', timeout, multipacket=False)
+    if responses is None:
+        return None
+    lines = responses[0].split('\n')
+    if lines[0] != 'statusResponse' or len(lines) < 2:
+        return None
+    infostring = lines[1].split('\\')[1:] # \key\value\key\value...
+    status = dict(zip(infostring[0::2], infostring[1::2]))
+    status['players'] = []
+    for line in lines[2:]:
+        match = re.match(r'(-?\d+) (\d+) "(.*)"', line)
+        if match:
+            status['players'].append({'score': int(match.group(1)), 'ping': int(match.group(2)), 'name': match.group(3)})
+    return status
+
+# Cache of the last getstatus of each server, so that several checks in a short time only send one packet: (host, port) -> (time, status)
+server_status_cache = dict()
+
+# Get the status of a server (see q3_getstatus), from the cache if it's not older than maxage seconds
+def get_server_status(host, port, maxage = 5):
+    key = (host, str(port))
+    if server_status_cache.has_key(key) and time.time() - server_status_cache[key][0] <= maxage:
+        return server_status_cache[key][1]
+    status = q3_getstatus(host, port)
+    server_status_cache[key] = (time.time(), status)
+    return status
+
+# Wait until a server answers to getstatus, and return the time waited in seconds since start (or None if it did not answer before the timeout)
+def wait_for_server(host, port, timeout = 60, start = None):
+    if start is None:
+        start = time.time()
+    while time.time() - start < timeout:
+        if q3_getstatus(host, port, 0.5) is not None:
+            return time.time() - start
+        time.sleep(0.5)
+    return None
+
+# Count the human players in a status (bots have a ping of 0)
+def count_humans(status):
+    return len([player for player in status['players'] if player['ping'] > 0])
+
+# Wait for the end of the match running on a server, up to cap seconds: the match is considered over when there's no human player anymore, when the map changes or when the scores are reset (a new match began)
+# If the game log is followed (gamelog, see GameLog), the first match end seen in the log also ends the wait (the eventloop is then needed to read the log), and if the server does not answer we still wait when the log shows a match in progress
+# Returns the number of seconds waited and the reason, or None if the server does not answer (so we don't know)
+def wait_for_match_end(host, port, cap, pollinterval = 5, eventloop = None, gamelog = None):
+    start = time.time()
+    status = get_server_status(host, port, 0)
+    if status is None and (gamelog is None or not gamelog.playing):
+        return [None, 'no answer']
+    if status is not None and count_humans(status) == 0:
+        return [0, 'empty server']
+    if status is not None:
+        mapname = status.get('mapname')
+        lastscore = sum([player['score'] for player in status['players']])
+    if gamelog is not None:
+        matchends = gamelog.matchends
+    while time.time() - start < cap:
+        delay = min(pollinterval, cap - (time.time() - start))
+        if eventloop is not None:
+            eventloop.run_until(time.time() + delay) # stopped by the game log listener on a match end
+            if eventloop.interrupted:
+                return [time.time() - start, 'interrupted']
+        else:
+            time.sleep(delay)
+        if gamelog is not None and gamelog.matchends > matchends:
+            return [time.time() - start, 'match end in the log']
+        if status is None: # only the log is available
+            continue
+        status = get_server_status(host, port, 0)
+        if status is None: # the server went down meanwhile, nothing to wait for
+            return [time.time() - start, 'no answer']
+        score = sum([player['score'] for player in status['players']])
+        if count_humans(status) == 0:
+            return [time.time() - start, 'players left']
+        if status.get('mapname') != mapname:
+            return [time.time() - start, 'map changed']
+        if score < lastscore:
+            return [time.time() - start, 'new match']
+        lastscore = score
+    return [time.time() - start, 'cap reached']
+
+# Query (by rcon) the list of the games a GTV server is connected to, as a list of 'address:port' strings (or None if the GTV server did not answer)
+def query_gtv_connections(host, port, password, command = 'gtv_list', timeout = 1.0):
+    output = q3_rcon(host, port, password, command, timeout)
+    if output is None:
+        return None
+    return re.findall(r'([\w.-]+:\d+)', output)
+
+# State of the GTV server's connections, so that we only issue the disconnects and reconnects that are needed
+# note: this state is followed when the GTV commands are precompiled in the plan (see compile_dayplan), and set when they are executed (see resolve_gtv_command)
+gtv_connections = None # list of the games ('address:port') the GTV server is connected to, None if unknown
+gtv_target = None # (address:port, password) of the game the GTV server was last connected to by the rotator
+gtv_rcon = None # (address, port, rcon password, status command) of the GTV server, to query its connections when they are unknown (set from commandline, None to disable)
+gtv_query_timeout = 0.5 # seconds to wait for the answer of the GTV server when its connections are queried during a transition (see resolve_gtv_command)
+
+def get_gtv_state():
+    return [list(gtv_connections) if gtv_connections is not None else None, gtv_target]
+
+def set_gtv_state(state):
+    global gtv_connections, gtv_target
+    gtv_connections = list(state[0]) if state[0] is not None else None
+    gtv_target = state[1]
+
+# Forget the connections of the GTV server (eg: because it is going to be restarted, so it will connect to the games specified in its config)
+def forget_gtv_connections():
+    global gtv_connections, gtv_target
+    gtv_connections = None
+    gtv_target = None
+
+# Get the connections of the GTV server (the known state, or queried to the GTV server if unknown and query is True)
+def get_gtv_connections(query = True, timeout = 1.0):
+    global gtv_connections
+    if gtv_connections is None and query and gtv_rcon is not None:
+        gtv_connections = query_gtv_connections(*gtv_rcon, timeout=timeout)
+    return gtv_connections
+
+# Outputs a list of commands to disconnect a gtv server from all games
+def gtv_disconnect_all(query = True):
+    global gtv_connections, gtv_target
+    connections = get_gtv_connections(query)
+    if connections is None:
+        nbdisconnects = 12 # we don't know how many games the GTV server is connected to, so we disconnect blindly (12 should be enough)
+    else:
+        nbdisconnects = len(connections)
+    gtv_connections = []
+    gtv_target = None
+    return ['gtv_disconnect'] * nbdisconnects
+
+# Outputs a list of commands to reconnect a gtv server
+# only the needed commands are issued: nothing if the GTV server is already connected to the same game with the same password
+def gtv_reconnect(servport, servaddr = "localhost", password = '', query = True):
+    global gtv_connections, gtv_target
     gtvingamecommands = []
     if servport:
         if type(servport) == list: servport = servport[0]
+        if not password: password = ''
+        target = servaddr+':'+servport
+        connections = get_gtv_connections(query)
+        if connections is not None and target in connections and gtv_target == (target, password):
+            return gtvingamecommands # already connected to the right game with the right password
         # The only technic to change the connection password of a gtv server, is to disconnect all games, and recreate them
-        for i in range(0,12):
-            gtvingamecommands.append('gtv_disconnect') # disconnect all games (12 should be enough)
-        if password and password != '':
-            gtvingamecommands.append('gtv_connect '+servaddr+':'+servport+' "'+password+'"') # reconnect, but this time with the new password
+        gtvingamecommands.extend(gtv_disconnect_all(query))
+        if password != '':
+            gtvingamecommands.append('gtv_connect '+target+' "'+password+'"') # reconnect, but this time with the new password
         else:
-            gtvingamecommands.append('gtv_connect '+servaddr+':'+servport) # reconnect without password
+            gtvingamecommands.append('gtv_connect '+target) # reconnect without password
+        gtv_connections = [target]
+        gtv_target = (target, password)
     return gtvingamecommands
 
+# Make the string of ingame commands to pass to oamps.sh (with -e or --gtvexec)
+# If cfgfolder is specified, the commands are written in a generated config file in this folder (which must be in the game's search path, eg: homepath/baseoa) and the returned string is just the command to exec this config: this avoids overflowing the Q3 command buffer with too long commands lines, whatever the size of the slot is
+# The name of the generated config contains the hash of its content, so that an existing file is reused when the same set of commands is needed again (the plan of the day is compiled in advance, so each slot needs its own file until it is applied), and the configs not used anymore are removed by remove_generated_cfgs
+generated_cfgs = set() # paths of the generated configs made since the last cleanup
+def make_exec_string(ingamecommands, cfgfolder = None, prefix = 'oa-game-rotator'):
+    if not cfgfolder:
+        return ';'.join(ingamecommands)
+
+    content = '\n'.join(ingamecommands) + '\n'
+    cfgname = prefix + '-' + hashlib.sha1(content).hexdigest()[:16] + '.cfg'
+    cfgpath = os.path.join(cfgfolder, cfgname)
+    try:
+        if not os.path.exists(cfgpath) or os.path.getsize(cfgpath) != len(content):
+            # Write in a temporary file and then rename, so that the game server can never exec a partially written config (only readable by the owner, since it may contain the passwords of the booking)
+            fd = os.open(cfgpath+'.tmp', os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            os.fchmod(fd, 0o600) # also if a temporary file was left by a previous run
+            f = os.fdopen(fd, 'w')
+            f.write(content)
+            f.close()
+            os.rename(cfgpath+'.tmp', cfgpath)
+    except (IOError, OSError) as inst: # if we can't write the config, we fallback to passing the commands directly
+        print('ERROR: Could not write the generated config '+cfgpath+', the commands will be sent directly. Error: '+str(inst))
+        return ';'.join(ingamecommands)
+    generated_cfgs.add(cfgpath)
+    return 'exec ' + cfgname
+
+# Remove the generated configs of a folder that were not made since the last cleanup, so that they don't pile up (they contain the passwords of the bookings)
+# This is called right after the plan of the day is compiled: the configs of its entries (including the running slot, compiled again) are kept, the older ones are superseded
+def remove_generated_cfgs(cfgfolder, prefix = 'oa-game-rotator'):
+    import glob
+    for cfgpath in glob.glob(os.path.join(cfgfolder, prefix + '-*.cfg')):
+        if cfgpath not in generated_cfgs:
+            try:
+                os.remove(cfgpath)
+            except OSError as inst:
+                print('ERROR: Could not remove the superseded generated config '+cfgpath+'. Error: '+str(inst))
+
+
+# Make the GTV commands from the GTV command built by make_oamps_command (a dict with the base command, its ingame commands, the wanted connection and if the GTV server is restarted), for the current state of the GTV server's connections (which is updated)
+def make_gtv_commands(gtv, query = True):
+    gtvcommand = gtv['gtvcommand']
+    gtvingamecommands = list(gtv['gtvexec'])
+    # GTV connection: if the GTV server is going to be restarted, we can't know to which games it will be connected (the ones in its config), so we disconnect blindly
+    if gtv['restart']:
+        forget_gtv_connections()
+    if gtv['connect'] is False:
+        gtvingamecommands[0:0] = gtv_disconnect_all(query=query and not gtv['restart'])
+    elif gtv['connect'] is not None:
+        gtvingamecommands[0:0] = gtv_reconnect(gtv['connect'][0], password=gtv['connect'][1], query=query and not gtv['restart'])
+
+    if gtvingamecommands != []:
+        gtvcommand +=  ' --gtvexec \'' + make_exec_string(gtvingamecommands, gtv['cfgfolder']) + '\''
+        if gtv['execdelay'] is not None: # by default, we set an execdelay of 60 for gtv (can be overriden by commandline or slot parameter)
+            gtvcommand += ' --gtvexecdelay ' + str(gtv['execdelay'])
+    if gtv['startup']:
+        gtvcommand += ' -r'
+    return [gtvcommand] * gtv['repeat']
+
+# Get the final commands of a GTV command built by make_oamps_command, when it is executed
+# The commands are precompiled for the connections the GTV server should have at this time (assumed): if it has them, which is the usual case, nothing is built nor queried during the transition
+# Else (eg: a transition applied out of order), they are made again for the real connections, and if these are unknown the GTV server is queried with a short timeout (gtv_query_timeout): if it does not answer in time, the precompiled commands are used
+def resolve_gtv_command(gtv):
+    if get_gtv_state() == gtv['assumed']:
+        set_gtv_state(gtv['result'])
+        return gtv['commands']
+    if not gtv['restart'] and gtv['connect'] is not None and gtv_rcon is not None and get_gtv_connections(timeout=gtv_query_timeout) is None:
+        print('ERROR: the GTV server did not answer in '+str(gtv_query_timeout)+' seconds, the precompiled GTV commands are sent.')
+        set_gtv_state(gtv['result'])
+        return gtv['commands']
+    return make_gtv_commands(gtv, query=False)
+
+# Expand the GTV commands of a list of commands (see resolve_gtv_command), the other commands are kept as they are
+def expand_commands(commands):
+    expanded = []
+    for command in commands:
+        if isinstance(command, dict):
+            expanded.extend(resolve_gtv_command(command))
+        else:
+            expanded.append(command)
+    return expanded
+
+
+# Mod profiles: declare for each mod which cvars exist, the restart style and the default repeat count, so that only the commands relevant to the running mod are sent
+# To support a new mod, just add its profile here (the name being the gamemod as given to oamps.sh)
+# - refcvars: the cvars that contain the referee password
+# - softrestart: the ingame command used to restart the map (so that the changes take effect)
+# - repeat: default number of times the commands are sent when the server is (re)started, if no repeatX is specified in the slot (eg: AfterShock lags as hell if restarted only once)
+# - gamerestart: True if we can switch to this mod inside the running server with ioquake3's game_restart (with --game-restart), instead of a full restart of the server
+modprofiles = {
+    'baseoa': {'refcvars': [], 'softrestart': 'map_restart', 'repeat': 1, 'gamerestart': True},
+    'aftershock': {'refcvars': ['g_refPassword'], 'softrestart': 'map_restart', 'repeat': 2, 'gamerestart': True},
+    'excessiveplus': {'refcvars': ['refereePassword'], 'softrestart': 'map_restart', 'repeat': 1, 'gamerestart': True},
+    'cpma': {'refcvars': ['ref_password'], 'softrestart': 'map_restart', 'repeat': 1, 'gamerestart': True},
+}
+# Profile used when we don't know which mod is running (eg: no gamemod was ever specified): all the known referee passwords cvars are set to be safe
+defaultmodprofile = {'refcvars': ['g_refPassword', 'refereePassword', 'ref_password'], 'softrestart': 'map_restart', 'repeat': 1, 'gamerestart': False}
+
+# Get the profile of a mod (or the default profile if the mod is unknown)
+def get_mod_profile(gamemod):
+    if gamemod and modprofiles.has_key(gamemod.lower()):
+        return modprofiles[gamemod.lower()]
+    else:
+        return defaultmodprofile
+
+# Context of the construction of the commands for one slot, passed to the slot parameters handlers
+# The handlers directly fill the parameters dictionaries (oampsparams, gtvparams) and the ingame commands lists (ingamecommands, gtvingamecommands)
+class SlotContext(object):
+    def __init__(self, slot, defaultconfig, oampsargs, oampsparams, gtvparams, ingamecommands, gtvingamecommands, profile):
+        self.slot = slot # the full slot (to check the other parameters)
+        self.defaultconfig = defaultconfig
+        self.oampsargs = oampsargs # commandline arguments
+        self.oampsparams = oampsparams
+        self.gtvparams = gtvparams
+        self.ingamecommands = ingamecommands
+        self.gtvingamecommands = gtvingamecommands
+        self.profile = profile # profile of the mod running during this slot
+        self.cmdrepeat = None # None means that the default repeat count of the mod's profile will be used
+        self.gtvcmdrepeat = 1
+        self.gtvconnect = None # GTV connection wanted for this slot: None to keep it as is, False to disconnect, or a (port, password) tuple to connect to the game server (the commands are made once we know if the GTV server will be restarted)
+
+#-- Slot parameters handlers: each handler takes the context, the parameter and its value (as a string)
+
+# Booking parameters
+def handle_password(context, parameter, value):
+    context.ingamecommands.append('seta g_password "'+value+'"') # NEVER use a single quote in Q3 commands, always double quote (but in bash we can use single quotes)
+
+def handle_refpassword(context, parameter, value):
+    for refsetting in context.profile['refcvars']:
+        context.ingamecommands.append('seta ' + str(refsetting) + ' "' + value + '"')
+
+def handle_repeat(context, parameter, value):
+    # Multiple repeat: repeatx with x the number of consecutive resending of the same command, particularly useful to restart twice an AfterShock server (eg: repeat2)
+    if len(parameter) > len('repeat'):
+        context.cmdrepeat = int(parameter[len('repeat'):])
+    else:
+        handle_oamps_param(context, parameter, value)
+
+def handle_restart_hard(context, parameter, value):
+    # A hard restart will completely shutdown the server and restart it with the given arguments (this is necessary to change mod, unless --game-restart is used: see the mod switch strategy in make_oamps_command)
+    context.oampsparams['restart'] = ''
+
+def handle_restart_soft(context, parameter, value):
+    # A soft restart consists in reloading the config and restart the map (and resetting g_password if none is specified)
+    if context.slot.has_key('config'):
+        conf = context.slot['config']
+    else:
+        conf = context.defaultconfig
+    if not context.slot.has_key('password'): # If there's no g_password for this session, we reset the g_password
+        context.ingamecommands.append('seta g_password ""')
+    if not context.slot.has_key('refpassword'): # If there's no ref_password for this session, we reset the ref_password
+        for refsetting in context.profile['refcvars']:
+            context.ingamecommands.append('seta ' + str(refsetting) + ' ""')
+    context.ingamecommands.append('exec '+conf) # execing the config
+    context.ingamecommands.append(context.profile['softrestart']) # restarting the map for the changes to take effect (it's a soft restart, so we have to do that)
+    # reconnect GTV now that the server become public again (in the case the previous booking disabled GTV, if it didn't, GTV should still be able to connect without a change)
+    if context.gtvconnect is None: context.gtvconnect = (context.oampsargs.get('port'), '') # unless the gtv parameter says otherwise
+
+# GTV management (if gtv is enabled, we must do a lot of stuff to activate/disable it on the booked server)
+def handle_gtv(context, parameter, value):
+    if value == 'yes':
+        context.gtvconnect = (context.oampsargs.get('port'), context.slot.get('password', ''))
+    elif value == 'no': # else we disconnect gtv so that it does not try to reconnect every few seconds uselessly (since gtv is disabled), because without the password it can't reconnect anyway
+        context.gtvconnect = False
+    else:
+        handle_gtv_param(context, parameter, value)
+
+def handle_gtvrestart_hard(context, parameter, value):
+    # A hard restart will completely shutdown the server and restart it with the given arguments (this is necessary to change mod)
+    context.gtvparams['restart'] = ''
+
+def handle_gtvrepeat(context, parameter, value):
+    # Multiple GTV repeat: gtvrepeatx with x the number of consecutive resending of the same command to a GTV server (eg: gtvrepeat2)
+    if len(parameter) > len('gtvrepeat'):
+        context.gtvcmdrepeat = int(parameter[len('gtvrepeat'):])
+    else:
+        handle_gtv_param(context, parameter, value)
+
+# gtv exec = ingame commands for gtv
+def handle_gtvexec(context, parameter, value):
+    context.gtvingamecommands.append(value)
+
+# any other gtv parameter is put in the gtvparams dictionnary
+def handle_gtv_param(context, parameter, value):
+    context.gtvparams[str(parameter)] = value
+
+# Private event: if it's private, we disable recording facilities
+def handle_show_public(context, parameter, value):
+    if value == 'no':
+        context.ingamecommands.append('set sv_autoDemo 0')
+    else:
+        context.ingamecommands.append('set sv_autoDemo 1')
+
+# Other ingame parameters (for standard use of the game rotator, like to change maps, mods, etc...)
+def handle_map(context, parameter, value):
+    context.ingamecommands.append('map "'+value+'"')
+
+# If we pass in the --exec argument, we must put it in the ingamecommands array
+def handle_exec(context, parameter, value):
+    context.ingamecommands.append(value)
+
+# special case: if verbose, this should be applied to all commands: for game server and gtv server
+def handle_verbose(context, parameter, value):
+    context.oampsparams[str(parameter)] = value
+    context.gtvparams[str(parameter)] = value
+
+# useless parameters (could be just ignored because oamps.sh will ignore them anyway, but it's cleaner to remove them)
+def handle_ignore(context, parameter, value):
+    return
+
+# General oamps parameters parser
+# any other non special parameter in a slot will simply be taken as a commandline argument for oamps (this allows for specific behaviors depending on the mod, like setting the vm, homepath, basepath, etc.)
+def handle_oamps_param(context, parameter, value):
+    context.oampsparams[str(parameter)] = value
+
+# Handlers registry: handlers by exact parameter name, and handlers by prefix (the longest matching prefix wins)
+# Any parameter matching none of them is passed to oamps.sh (handle_oamps_param)
+slothandlers = {
+    'password': handle_password,
+    'refpassword': handle_refpassword,
+    'restart_hard': handle_restart_hard,
+    'restart_soft': handle_restart_soft,
+    'gtv': handle_gtv,
+    'gtvrestart_hard': handle_gtvrestart_hard,
+    'gtvexec': handle_gtvexec,
+    'show_public': handle_show_public,
+    'map': handle_map,
+    'exec': handle_exec,
+    'verbose': handle_verbose,
+    'clan': handle_ignore,
+}
+slotprefixhandlers = [
+    ('gtvrepeat', handle_gtvrepeat),
+    ('repeat', handle_repeat),
+    ('gtv', handle_gtv_param),
+    ('heartbeat', handle_gtv_param),
+]
+slothandlerscache = dict() # parameter name -> handler, so that the handler of a parameter is resolved only once
+
+# Register a handler for a slot parameter (or for all the parameters beginning with a prefix if prefix is True)
+# The handler must be a function taking the context (SlotContext), the parameter and its value
+def register_slot_handler(name, handler, prefix = False):
+    if prefix:
+        slotprefixhandlers.append((name, handler))
+        slotprefixhandlers.sort(key=lambda x: len(x[0]), reverse=True) # longest prefixes first
+    else:
+        slothandlers[name] = handler
+    slothandlerscache.clear()
+
+# Get the handler of a slot parameter (resolved once then cached)
+def get_slot_handler(parameter):
+    handler = slothandlerscache.get(parameter)
+    if handler is None:
+        handler = slothandlers.get(parameter)
+        if handler is None:
+            for prefix, prefixhandler in slotprefixhandlers:
+                if parameter.startswith(prefix):
+                    handler = prefixhandler
+                    break
+            else:
+                handler = handle_oamps_param
+        slothandlerscache[parameter] = handler
+    return handler
+
+# Load the slot parameters handlers of third-party packages, registered with the 'oa_game_rotator.slot_handlers' entry point
+# The name of the entry point is the parameter name (or a prefix if it ends with a *), eg: mymod_* = mypackage.handlers:handle_mymod
+def load_slot_handlers_plugins():
+    try:
+        import pkg_resources
+    except ImportError: # setuptools is not installed, so there can't be any plugin
+        return
+    for entrypoint in pkg_resources.iter_entry_points('oa_game_rotator.slot_handlers'):
+        try:
+            handler = entrypoint.load()
+        except Exception as inst:
+            print('ERROR: Could not load the slot handler '+entrypoint.name+' from '+str(entrypoint.dist)+'. Error: '+str(inst))
+            continue
+        if entrypoint.name.endswith('*'):
+            register_slot_handler(entrypoint.name[:-1], handler, prefix=True)
+        else:
+            register_slot_handler(entrypoint.name, handler)
+        print('Loaded slot handler '+entrypoint.name+' from '+str(entrypoint.dist))
 
 # Construct one or several string containing the commands to be executed (for booking)
 last_binfullpath = ''
 last_gtvfullpath = ''
-def make_oamps_command(defaultconfig, defaultmod, oampsarguments, slot = None, startup = False, oampsfullpath = None):
+last_gamemod = None
+last_serverpaths = None # (binary, basepath, homepath) of the game server when it was last (re)started
+desired_state = {'password': None, 'map': None, 'gamemod': None} # state the game server should be in after the last built slot (None when unknown, eg: the password or map set by the config after a restart), checked by the health check
+
+# Get the states kept by make_oamps_command between the slots, to set them back later (see compile_dayplan)
+def get_command_state():
+    return {'binfullpath': last_binfullpath, 'gtvfullpath': last_gtvfullpath, 'gamemod': last_gamemod, 'serverpaths': last_serverpaths, 'desired': desired_state.copy()}
+
+def set_command_state(state):
+    global last_binfullpath, last_gtvfullpath, last_gamemod, last_serverpaths, desired_state
+    last_binfullpath = state['binfullpath']
+    last_gtvfullpath = state['gtvfullpath']
+    last_gamemod = state['gamemod']
+    last_serverpaths = state['serverpaths']
+    desired_state = state['desired'].copy()
+
+# If info is a dict, it is filled with informations about the commands (to know what they do without having to parse them):
+# - restart: True if the game server is (re)started
+# - gamemod: the mod that will be running (None if unknown)
+# - nbgamecommands: the number of game server commands, at the beginning of the returned list (the rest being the GTV command, a dict with its precompiled commands, see resolve_gtv_command)
+# - modswitch: how the server is restarted: 'hard' (full restart of the process), 'game_restart' (mod switch inside the running server) or None (no restart)
+# If gamerestart is True, a mod switch is done with ioquake3's game_restart <mod> in the running server when the binary, basepath and homepath are unchanged (else it's a hard restart)
+# If gtvfollow is True, the GTV server is reconnected to this server even if the slot does not say anything about GTV (eg: the game moves to the standby port)
+def make_oamps_command(defaultconfig, defaultmod, oampsarguments, slot = None, startup = False, oampsfullpath = None, cfgfolder = None, gtvcfgfolder = None, info = None, gamerestart = False, gtvfollow = False):
 
     #-- Special variables
-    refarray = ["g_refPassword", "refereePassword", "ref_password"] # store the variables that contains the referee passwords. Add here more variables to support more mods. Currently supports: AfterShock, ExcessivePlus, CPMA
     default_cmddelay = 5 # default time to wait after restarting the game server before sending the commands to set password and map restart (can be overriden by using --execdelay at commandline)
     default_gtvcmddelay = 20 # default time to wait after changing game server password and map restart before reconnecting GTV (can be overriden by using --gtvexecdelay at commandline)
 
@@ -365,14 +1296,29 @@ def make_oamps_command(defaultconfig, defaultmod, oampsarguments, slot = None, s
 
     # Vars that stores how many times we will repeat the sending of the commands. By default 1, but can be modified in a slotsfile with repeatX parameter.
     # mainly used restart the server (game or gtv) multiple times, this is used in case of multiple consecutive restarts such as for aftershock, which lags as hell if restarted only once
-    cmdrepeat = 1
+    cmdrepeat = None # None means that the default repeat count of the mod's profile will be used
     gtvcmdrepeat = 1
+    gtvconnect = None # GTV connection wanted for this slot (see SlotContext)
 
     # Vars that store the last status
     # useful for restarting the server only when needed, such as when we change the binary in slotsfile (eg: enable multiview for gtv only for cpma and excessiveplus)
     # note: this could be replaced by properties in a class, and this should be cleaner, but this would be a lot more clunky and we use these variables only sparingly
     global last_binfullpath
     global last_gtvfullpath
+    global last_gamemod
+    global last_serverpaths
+    global desired_state
+
+    previousgamemod = last_gamemod
+    # Get the mod that will be running during this slot, so that we only send the commands relevant to this mod (if no gamemod is specified, the last one is kept, unless the server is restarted since we then don't know which mod oamps.sh will load)
+    if slot is None:
+        gamemod = defaultmod
+    else:
+        gamemod = slot.get('gamemod')
+    if not gamemod and not startup and (slot is None or not slot.has_key('restart_hard')):
+        gamemod = last_gamemod
+    last_gamemod = gamemod
+    profile = get_mod_profile(gamemod)
 
     #-- Make oamps arguments from commandline
     # we take commandline arguments from oa-game-rotator that are the same for oamps, and feed them to oamps
@@ -411,102 +1357,32 @@ def make_oamps_command(defaultconfig, defaultmod, oampsarguments, slot = None, s
         oampsparams['config'] = defaultconfig
         if defaultmod is not None and defaultmod != '': oampsparams['gamemod'] = defaultmod
         ingamecommands.append('seta g_password ""')
-        for refsetting in refarray:
+        for refsetting in profile['refcvars']:
             ingamecommands.append('seta ' + str(refsetting) + ' ""')
     else: # reading parameters from the slot (and eventually override commandline arguments)
+        # each parameter is processed by its handler (see slothandlers), which fills the parameters and commands lists in the context
+        context = SlotContext(slot, defaultconfig, oampsargs, oampsparams, gtvparams, ingamecommands, gtvingamecommands, profile)
         for parameter, value in slot.iteritems():
-            # convert value to string
-            value = str(value)
-
-            # Booking parameters
-            if parameter == 'password':
-                ingamecommands.append('seta g_password "'+value+'"') # NEVER use a single quote in Q3 commands, always double quote (but in bash we can use single quotes)
-            elif parameter == 'refpassword':
-                for refsetting in refarray:
-                    ingamecommands.append('seta ' + str(refsetting) + ' "' + value + '"')
-            elif 'repeat' in parameter and len(parameter) > len('repeat'):
-                # Multiple repeat: repeatx with x the number of consecutive resending of the same command, particularly useful to restart twice an AfterShock server (eg: repeat2)
-                cmdrepeat = int(parameter.replace('repeat', ''))
-            elif parameter == 'restart_hard':
-                # A hard restart will completely shutdown the server and restart it with the given arguments (this is necessary to change mod) #FIXME: with ioquake3 it's possible to use game_restart <mod>
-                oampsparams['restart'] = ''
-            elif parameter == 'restart_soft':
-                # A soft restart consists in reloading the config and restart the map (and resetting g_password if none is specified)
-                if slot.has_key('config'):
-                    conf = slot['config']
-                else:
-                    conf = defaultconfig
-                if not slot.has_key('password'): # If there's no g_password for this session, we reset the g_password
-                    ingamecommands.append('seta g_password ""')
-                if not slot.has_key('refpassword'): # If there's no ref_password for this session, we reset the ref_password
-                    ingamecommands.append('seta ref_password ""')
-                    ingamecommands.append('seta refereePassword ""')
-                ingamecommands.append('exec '+conf) # execing the config
-                ingamecommands.append('map_restart') # restarting the map for the changes to take effect (it's a soft restart, so we have to do that)
-                # reconnect GTV now that the server become public again (in the case the previous booking disabled GTV, if it didn't, GTV should still be able to connect without a change)
-                if oampsargs.has_key('port'): gtvingamecommands.extend(gtv_reconnect(oampsargs['port']))
-
-            # GTV management (if gtv is enabled, we must do a lot of stuff to activate/disable it on the booked server)
-            elif parameter == 'gtv' and value == 'yes' and oampsargs.has_key('port') is not None:
-                if slot.has_key('password'):
-                    gtvingamecommands.extend(gtv_reconnect(oampsargs['port'], password=slot['password']))
-                else:
-                    gtvingamecommands.extend(gtv_reconnect(oampsargs['port']))
-            elif parameter == 'gtv' and value == 'no': # else we disconnect gtv so that it does not try to reconnect every few seconds uselessly (since gtv is disabled), because without the password it can't reconnect anyway
-                for i in range(0,12):
-                    gtvingamecommands.append('gtv_disconnect') # disconnect all games (12 should be enough)
-            elif parameter == 'gtvrestart_hard':
-                # A hard restart will completely shutdown the server and restart it with the given arguments (this is necessary to change mod)
-                gtvparams['restart'] = ''
-            elif 'gtvrepeat' in parameter and len(parameter) > len('gtvrepeat'):
-                # Multiple GTV repeat: gtvrepeatx with x the number of consecutive resending of the same command to a GTV server (eg: gtvrepeat2)
-                gtvcmdrepeat = int(parameter.replace('gtvrepeat', ''))
-            # gtv exec = ingame commands for gtv
-            elif parameter == 'gtvexec':
-                gtvingamecommands.append(value)
-            # special case: if this is a gtv command (except gtvexec that must be treated separately, and before), we put it in the gtvparams dictionnary
-            # note: this must be last for gtv commands or else it will interfere with other special cases
-            elif 'gtv' in str(parameter) or 'heartbeat' in str(parameter):
-                gtvparams[str(parameter)] = value
-
-            # Private event: if it's private, we disable recording facilities
-            elif 'show_public' in str(parameter):
-                if value == 'no':
-                    ingamecommands.append('set sv_autoDemo 0')
-                else:
-                    ingamecommands.append('set sv_autoDemo 1')
-
-
-            # Other ingame parameters (for standard use of the game rotator, like to change maps, mods, etc...)
-            elif parameter == 'map':
-                ingamecommands.append('map "'+value+'"')
-            # If we pass in the --exec argument, we must put it in the ingamecommands array
-            elif parameter == 'exec':
-                ingamecommands.append(value)
-            # special case: if verbose, this should be applied to all commands: for game server and gtv server
-            elif parameter == 'verbose':
-                oampsparams[str(parameter)] = value
-                gtvparams[str(parameter)] = value
-
-            # useless parameters (could be just ignored because oamps.sh will ignore them anyway, but it's cleaner to remove them)
-            elif parameter == 'clan':
-                None;
-
-            # General oamps parameters parser
-            # any other non special parameter in a slot will simply be taken as a commandline argument for oamps (this allows for specific behaviors depending on the mod, like setting the vm, homepath, basepath, etc.)
-            else:
-                oampsparams[str(parameter)] = value
-            #else: # in any other case than specific to booking a server, we add them to ingamecommands and will be executed directly as in-game q3 commands (be careful to not put here too many for one slot, else it can overflow!)
-            #    ingamecommands.append('seta '+str(parameter)+' "'+value+'"')
+            get_slot_handler(parameter)(context, parameter, str(value)) # convert value to string
+        cmdrepeat = context.cmdrepeat
+        gtvcmdrepeat = context.gtvcmdrepeat
+        gtvconnect = context.gtvconnect
+    if gtvconnect is None and gtvfollow:
+        gtvconnect = (oampsargs.get('port'), slot.get('password', '') if slot else '')
 
 
     #-- Build the final commands strings
 
     # Countdown management: if a countdown is specified but we are not going to restart (soft or hard) the server, then we should not notice the players with a countdown
-    if oampsparams.has_key('countdown') and not ('map_restart' in ingamecommands or oampsparams.has_key('restart') or startup):
+    if oampsparams.has_key('countdown') and not (profile['softrestart'] in ingamecommands or oampsparams.has_key('restart') or startup):
         del oampsparams['countdown']
     elif oampsparams.has_key('countdown') and startup: # in the case it's the first time we launch this script, we probably want to restart the server fresh ASAP. FIXME: if you want the server to restart after a countdown at startup, then remove this condition
         del oampsparams['countdown']
+    # the countdown is done by the rotator itself before the transition (see countdownwait), not by oamps.sh
+    countdown = None
+    if oampsparams.has_key('countdown'):
+        countdown = int(oampsparams.pop('countdown'))
+    countdownmessage = oampsparams.pop('countdownmessage', None)
 
 
     # Special case: we change binary, so we have to relaunch the server in any case (but only if it changed since the last slot)
@@ -528,6 +1404,24 @@ def make_oamps_command(defaultconfig, defaultmod, oampsarguments, slot = None, s
         last_gtvfullpath = gtvfullpath
     if not oampsargs.has_key('restart_soft') and not defaultmod: last_gtvfullpath = gtvfullpath
 
+    # Mod switch strategy: a hard restart kills the server and relaunches it, but if only the mod changes (same binary, basepath and homepath), ioquake3 can switch the mod inside the running server with game_restart, which is a lot faster
+    modswitch = None
+    if oampsparams.has_key('restart') or startup:
+        serverpaths = (oampsparams.get('binfullpath', ''), oampsparams.get('basepath', ''), oampsparams.get('homepath', ''))
+        if (gamerestart and not startup and slot is not None and last_serverpaths == serverpaths
+            and gamemod and previousgamemod and gamemod != previousgamemod and profile.get('gamerestart')):
+            modswitch = 'game_restart'
+            del oampsparams['restart']
+            if oampsparams.has_key('gamemod'): del oampsparams['gamemod']
+            # switch the mod, then set the vm and load the config as it would be at launch (the config must load a map, as for a hard restart), and then the other ingame commands
+            gamerestartcommands = ['game_restart '+gamemod]
+            if oampsparams.has_key('vmgame'): gamerestartcommands.append('set vm_game '+oampsparams['vmgame'])
+            gamerestartcommands.append('exec '+oampsparams.get('config', defaultconfig))
+            ingamecommands[0:0] = gamerestartcommands
+        else:
+            modswitch = 'hard'
+        last_serverpaths = serverpaths
+
     # Main command: oamps commandline arguments (other than ingame commands -e)
     for parameter, value in oampsparams.iteritems():
         if value is not None and value != '':
@@ -537,9 +1431,11 @@ def make_oamps_command(defaultconfig, defaultmod, oampsarguments, slot = None, s
 
     # Ingame commands: add to oamps commandline some ingame commands to execute
     # If we have some q3 ingame commands to execute directly in the console (ingamecommands), we add them in our main command var
+    execstring = None
     if ingamecommands != []:
-        if oampsparams.has_key('restart') or startup: ingamecommands.append('map_restart') # restarting the map for the changes to take effect (only if the booking changed, if not we don't want the map to be restarted each slot even if it's the same booking! that's why do if it's hard or soft restarting the server)
-        command +=  ' -e \'' + ';'.join(ingamecommands) + '\'' # we can use a single quote when passing arguments in bash shell, but this does not work in OA, only double quotes work, so using single quotes in commandline permits to escape double quotes in OA ingame commands
+        if oampsparams.has_key('restart') or startup: ingamecommands.append(profile['softrestart']) # restarting the map for the changes to take effect (only if the booking changed, if not we don't want the map to be restarted each slot even if it's the same booking! that's why do if it's hard or soft restarting the server)
+        execstring = make_exec_string(ingamecommands, cfgfolder)
+        command +=  ' -e \'' + execstring + '\'' # the commands are either written in a generated config (if cfgfolder is set) or passed directly. We can use a single quote when passing arguments in bash shell, but this does not work in OA, only double quotes work, so using single quotes in commandline permits to escape double quotes in OA ingame commands
         if not oampsparams.has_key('execdelay'): # by default, we set an execdelay of 30 (can be overriden by commandline or slot parameter)
             command += ' --execdelay ' + str(int(default_cmddelay))
 
@@ -555,35 +1451,1499 @@ def make_oamps_command(defaultconfig, defaultmod, oampsarguments, slot = None, s
                 gtvcommand += ' --' + parameter
 
         # GTV ingame commands: allows to reconnect to a booking where gtv is enabled (and to pass any ingame command to the gtv server)
-        if gtvingamecommands != []:
-            gtvcommand +=  ' --gtvexec \'' + ';'.join(gtvingamecommands) + '\''
-            if not gtvparams.has_key('gtvexecdelay'): # by default, we set an execdelay of 60 for gtv (can be overriden by commandline or slot parameter)
-                gtvcommand += ' --gtvexecdelay ' + str(int(default_gtvcmddelay))
+        # the commands to connect the GTV server depend on the games it is connected to at the time they are sent: they are precompiled below for the connections it should have then, and checked when they are executed (see resolve_gtv_command)
+        gtvcommand = {'gtvcommand': gtvcommand, 'gtvexec': gtvingamecommands, 'connect': list(gtvconnect) if gtvconnect else gtvconnect, 'restart': gtvparams.has_key('restart') or startup,
+                      'cfgfolder': gtvcfgfolder, 'execdelay': None if gtvparams.has_key('gtvexecdelay') else int(default_gtvcmddelay), 'startup': startup, 'repeat': gtvcmdrepeat}
     else: # else, if there's no gtvparams (the admin using oa-game-rotator has no gtv server), then this means that gtv is totally disabled, so we empty the gtvcommand so that no gtvcommand is issued (not really necessary but this spare one shell command and a few CPU cycles)
         gtvcommand = ''
 
-    # is used to append -r at startup, then the next iterations will do as the slotsfile require
+    # is used to append -r at startup, then the next iterations will do as the slotsfile require (for the GTV command, see make_gtv_commands)
     if startup:
         command += ' -r'
-        if gtvcommand != '': gtvcommand += ' -r'
 
     # Managing multiple consecutive restarts (useful for AfterShock)
     finalcmd = []
 
+    if cmdrepeat is None: # no repeatX in the slot: we use the mod's default, but only if the server is (re)started (no need to send twice the same ingame commands)
+        if oampsparams.has_key('restart') or startup:
+            cmdrepeat = profile['repeat']
+        else:
+            cmdrepeat = 1
+
     if cmdrepeat > 0:
         finalcmd.extend([command]) # we put at least one command as is, with all options
-        if oampsparams.has_key('countdown'): # if a countdown is set, we apply it only for the first command, for all the ones that follow, we don't use a countdown (eg: for aftershock servers that need to restarted twice, we don't want to restart it an hour later because of the countdown! the server must be restarted in a chain so that it's playable)
-            command = re.sub('''--countdown ['"]*[\d]+['"]*''', '', command)
         finalcmd.extend([command] * (cmdrepeat-1)) # we repeat the command as many times as necessary
 
+    # Desired state of the game server after this slot, to detect a drift (eg: a manual restart that reset the password of a private booking)
+    if oampsparams.has_key('restart') or startup or modswitch: # the server is (re)started with the config: what it sets is unknown
+        desired_state = {'password': None, 'map': None, 'gamemod': None}
+    desired_state['gamemod'] = gamemod
+    for ingamecommand in ingamecommands:
+        match = re.match(r'seta? g_password "(.*)"$', ingamecommand)
+        if match:
+            desired_state['password'] = match.group(1)
+        match = re.match(r'map "(.*)"$', ingamecommand)
+        if match:
+            desired_state['map'] = match.group(1)
+        elif ingamecommand.startswith('exec '): # a config may load another map
+            desired_state['map'] = None
+
+    if info is not None:
+        info['restart'] = oampsparams.has_key('restart') or startup
+        info['gamemod'] = gamemod
+        info['nbgamecommands'] = len(finalcmd)
+        info['modswitch'] = modswitch
+        info['oampsparams'] = oampsparams.copy() # parameters of the game server
+        info['console'] = [execstring] if execstring else [] # ingame commands of the game server (one console line)
+        info['basecommand'] = basecommand
+        info['desired'] = desired_state.copy()
+        info['countdown'] = countdown
+        info['countdownmessage'] = countdownmessage
+
     if gtvcmdrepeat > 0:
+        if gtvcommand != '':
+            gtvcommand['assumed'] = get_gtv_state()
+            gtvcommand['commands'] = make_gtv_commands(gtvcommand) # the GTV command is repeated there
+            gtvcommand['result'] = get_gtv_state()
         finalcmd.extend([gtvcommand])
-        if gtvparams.has_key('countdown'):
-            gtvcommand = re.sub('''--countdown ['"]*[\d]+['"]*''', '', gtvcommand)
-        finalcmd.extend([gtvcommand] * (gtvcmdrepeat-1))
 
     return finalcmd
 
+# Watch a file or directory with inotify (through ctypes, Linux only): returns the inotify file descriptor (readable when an event happens), or None if inotify is not available
+def inotify_watch(path, mask = 0x2 | 0x80 | 0x100): # IN_MODIFY | IN_MOVED_TO | IN_CREATE
+    try:
+        import ctypes, ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK)
+        if fd < 0:
+            return None
+        if libc.inotify_add_watch(fd, path, mask) < 0:
+            os.close(fd)
+            return None
+        return fd
+    except (OSError, AttributeError): # no libc or no inotify (not Linux)
+        return None
+
+# Streaming tail of a log file: the new lines are read incrementally (never the whole file again) when inotify notifies a change, or every pollinterval seconds if inotify is not available
+# The rotations of the file (moved and recreated, or truncated) are followed, and the memory is bounded: at most chunksize*maxchunks bytes are read per wakeup (the rest is read right after, so that the loop is not blocked on a busy server) and a line longer than maxline is dropped
+class LogTail(object):
+    def __init__(self, eventloop, path, callback, pollinterval = 1, chunksize = 65536, maxchunks = 16, maxline = 4096):
+        self.eventloop = eventloop
+        self.path = path
+        self.callback = callback # called with each new line
+        self.chunksize = chunksize
+        self.maxchunks = maxchunks
+        self.maxline = maxline
+        self.fd = None # raw file descriptor (the stdio files keep the end of file status, so they would not see the new lines)
+        self.inode = None
+        self.partial = '' # beginning of a line not completely written yet
+        self.skipping = False # dropping the end of a too long line
+        self.droppedlines = 0
+        self.open(fromstart = False) # the past events are not interesting, we start at the end of the file
+        self.inotifyfd = inotify_watch(os.path.dirname(os.path.abspath(path))) # the directory is watched, so that we also see the file being recreated
+        if self.inotifyfd is not None:
+            eventloop.add_reader(self.inotifyfd, self.notified)
+            pollinterval = max(pollinterval, 30) # just in case an event was missed
+        eventloop.add_timer(pollinterval, self.read)
+
+    def open(self, fromstart = True):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        try:
+            self.fd = os.open(self.path, os.O_RDONLY)
+        except OSError: # not created yet
+            self.inode = None
+            return
+        self.inode = os.fstat(self.fd).st_ino
+        if not fromstart:
+            os.lseek(self.fd, 0, os.SEEK_END)
+        self.partial = ''
+        self.skipping = False
+
+    def notified(self, fd):
+        try:
+            while os.read(fd, 4096): # drain the events, we only need to know that something changed
+                pass
+        except OSError:
+            pass
+        self.read()
+
+    # Read the new lines
+    def read(self):
+        # Rotation: the file was replaced (other inode) or truncated, we read the new one from the start
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return
+        if self.fd is None or stat.st_ino != self.inode:
+            if self.fd is not None:
+                while self.read_chunks(): # the end of the old file
+                    pass
+            self.open()
+        elif stat.st_size < os.lseek(self.fd, 0, os.SEEK_CUR):
+            self.open()
+        if self.fd is not None and self.read_chunks():
+            self.eventloop.add_timer(0, self.read, once=True) # there's more to read, but let the loop do something else first
+
+    # Read at most maxchunks chunks, and return True if there's more to read
+    def read_chunks(self):
+        for i in xrange(self.maxchunks):
+            data = os.read(self.fd, self.chunksize)
+            if not data:
+                return False
+            lines = (self.partial + data).split('\n')
+            self.partial = lines.pop()
+            if self.skipping and lines: # end of the too long line
+                lines.pop(0)
+                self.skipping = False
+            if self.skipping or len(self.partial) > self.maxline:
+                if not self.skipping:
+                    self.droppedlines += 1
+                self.partial = ''
+                self.skipping = True
+            for line in lines:
+                if len(line) <= self.maxline:
+                    self.callback(line.rstrip('\r'))
+                else:
+                    self.droppedlines += 1
+        return True
+
+# State of the game server parsed from its log (games.log): match in progress and match ends
+# The listeners are called with the event name and its argument (eg: 'exit', 'Fraglimit hit.') for each event
+class GameLog(object):
+    def __init__(self):
+        self.playing = False # is a match in progress (InitGame seen, and no Exit nor ShutdownGame since)?
+        self.matchends = 0 # number of match ends seen (Exit: or ShutdownGame:), to know if a match ended since some time
+        self.lastevent = None
+        self.listeners = []
+
+    # Parse a line of the log, eg: "  3:45 Exit: Fraglimit hit."
+    def feed(self, line):
+        match = re.match(r'\s*\d+:\d+\s+(\w+):\s*(.*)$', line)
+        if match is None:
+            return
+        name, argument = match.group(1), match.group(2)
+        if name == 'ClientConnect':
+            event = 'connect'
+        elif name == 'ClientDisconnect':
+            event = 'disconnect'
+        elif name == 'Exit':
+            self.matchends += 1
+            self.playing = False
+            event = 'exit'
+        elif name == 'ShutdownGame':
+            if self.lastevent != 'exit': # a shutdown without exit (eg: map change by a vote or a command) also ends the match
+                self.matchends += 1
+            self.playing = False
+            event = 'shutdown'
+        elif name == 'InitGame':
+            self.playing = True
+            event = 'init'
+        else:
+            return
+        self.lastevent = event
+        for listener in self.listeners:
+            listener(event, argument)
+
+# Master servers heartbeats sent by the rotator (instead of a heartbeater process and screen session per server started by oamps.sh): every interval seconds, all the servers are asked by rcon to send a heartbeat to their master servers
+# The master server checks the address the heartbeat comes from, so it must be sent by the server itself, hence the rcon. All the requests go through one shared non-blocking UDP socket, in one batch, and the answers are read (and ignored) by the eventloop
+# note: this assumes that the servers accept the heartbeat command by rcon (like the Quake 3 servers): check that the GTV server gets listed on its master server, else keep the heartbeater of oamps.sh (without --rcon-gtv-password)
+class Heartbeater(object):
+    def __init__(self, eventloop, interval = 300, command = 'heartbeat', verbose = False):
+        import socket
+        self.servers = [] # list of (address, port, rcon password)
+        self.command = command
+        self.verbose = verbose
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setblocking(0)
+        eventloop.add_reader(self.socket, self.read)
+        eventloop.add_timer(interval, self.beat, delay=min(interval, 10)) # the first heartbeat soon after the start, so that the servers are listed quickly
+
+    def add_server(self, host, port, password):
+        if (host, str(port), password) not in self.servers:
+            self.servers.append((host, str(port), password))
+
+    def beat(self):
+        import socket
+        for host, port, password in self.servers:
+            try:
+                self.socket.sendto('\xff\xff\xff\xffrcon "'+password+'" '+self.command+'\n', (host, int(port)))
+            except socket.error as inst:
+                print('ERROR: the heartbeat request could not be sent to '+host+':'+port+'. Error: '+str(inst))
+        if self.verbose:
+            print('Heartbeat requested to '+str(len(self.servers))+' server(s).')
+
+    def read(self, fd):
+        import socket
+        while 1:
+            try:
+                data, address = self.socket.recvfrom(65536)
+            except socket.error: # nothing more to read (or an ICMP error of a server that is down)
+                return
+            if self.verbose:
+                print('Heartbeat answer from '+address[0]+':'+str(address[1])+': '+data[4:].replace('print\n', '', 1).strip())
+
+# Make an oamps.sh command to send ingame commands to the game server with the parameters of a slot (see make_oamps_command's info), with a hard restart if restart is True
+def make_oamps_exec_command(basecommand, oampsparams, commands, restart = False, gamemod = None):
+    command = basecommand
+    for parameter, value in oampsparams.iteritems():
+        if parameter == 'restart':
+            continue
+        if value is not None and value != '':
+            command += ' --' + parameter + ' "' + value + '"'
+        else:
+            command += ' --' + parameter
+    if gamemod and not oampsparams.has_key('gamemod'):
+        command += ' --gamemod "' + gamemod + '"'
+    if restart:
+        command += ' --restart'
+        if not oampsparams.has_key('execdelay'): # wait for the server to be launched before sending the commands
+            command += ' --execdelay 5'
+    if commands:
+        command += ' -e \'' + ';'.join(commands) + '\''
+    return command
+
+# Convert a naive UTC datetime to a timestamp (seconds since epoch)
+def utc_to_timestamp(d):
+    return calendar.timegm(d.utctimetuple()) + d.microsecond/1000000.0
+
+# Minimal event loop: runs the timers (periodic callbacks), the readers of file descriptors and the signals callbacks while the rotator waits for the next deadline
+# so that background tasks (supervision, health checks, etc.) never block nor delay the transitions. Signals are delivered through a pipe (self-pipe trick) so that they wake up the loop, and their callbacks are called from the loop, not from the signal handler
+# note: the callbacks must be short and never block, and an error in a callback is printed but does not stop the loop
+class EventLoop(object):
+    def __init__(self):
+        self.timers = [] # list of timers, each timer being a list [next time, interval (None for a one-shot timer), callback]
+        self.readers = dict() # file descriptor -> callback (called with the file descriptor)
+        self.signalcallbacks = dict() # signal number -> list of callbacks (called with the signal number)
+        self.pendingsignals = []
+        self.stopped = False
+        self.interrupted = False # see interrupt()
+        self.wakeupread, self.wakeupwrite = os.pipe()
+        for fd in [self.wakeupread, self.wakeupwrite]:
+            import fcntl
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self.readers[self.wakeupread] = self._read_wakeup
+
+    # Call callback every interval seconds (the first time after delay seconds if specified, else after interval). If once is True, the callback is called only one time
+    def add_timer(self, interval, callback, delay = None, once = False):
+        if delay is None:
+            delay = interval
+        timer = [time.time() + delay, None if once else interval, callback]
+        self.timers.append(timer)
+        return timer
+
+    def remove_timer(self, timer):
+        if timer in self.timers:
+            self.timers.remove(timer)
+
+    # Call callback(fd) when the file descriptor (or an object with a fileno() method) is readable
+    def add_reader(self, fd, callback):
+        if hasattr(fd, 'fileno'):
+            fd = fd.fileno()
+        self.readers[fd] = callback
+
+    def remove_reader(self, fd):
+        if hasattr(fd, 'fileno'):
+            fd = fd.fileno()
+        if self.readers.has_key(fd):
+            del self.readers[fd]
+
+    # Call callback(signum) from the loop when the signal is received
+    def add_signal(self, signum, callback):
+        if not self.signalcallbacks.has_key(signum):
+            self.signalcallbacks[signum] = []
+            signal.signal(signum, self._signal_handler)
+            signal.siginterrupt(signum, False) # restart the system calls interrupted by the signal (the loop is woken up by the pipe anyway)
+        self.signalcallbacks[signum].append(callback)
+
+    def _signal_handler(self, signum, frame):
+        self.pendingsignals.append(signum)
+        try:
+            os.write(self.wakeupwrite, 'x')
+        except OSError: # the pipe is full, the loop will wake up anyway
+            pass
+
+    def _read_wakeup(self, fd):
+        try:
+            while os.read(fd, 512):
+                pass
+        except OSError:
+            pass
+
+    # Make run_until() return as soon as possible (eg: to reload the slotsfile), can be called from a callback
+    def stop(self):
+        self.stopped = True
+
+    # Make the waits (planwait, idlewait...) return before their deadline to do an action (eg: 'reload' for a command of the control socket), see take_action()
+    def interrupt(self, action = True):
+        self.interrupted = action
+        self.stop()
+
+    def _call(self, callback, *args):
+        try:
+            callback(*args)
+        except Exception as inst:
+            print('ERROR: in the event loop, '+str(getattr(callback, '__name__', callback))+' failed. Error: '+str(inst))
+
+    # Run the loop until the given timestamp. Returns True if the deadline was reached, False if the loop was stopped before
+    def run_until(self, deadline):
+        self.stopped = False
+        while not self.stopped:
+            now = time.time()
+            if now >= deadline:
+                return True
+            # wait until the next timer (or the deadline) for something to read
+            timeout = deadline - now
+            for timer in self.timers:
+                timeout = min(timeout, timer[0] - now)
+            try:
+                readable = select.select(self.readers.keys(), [], [], max(0, timeout))[0]
+            except (select.error, OSError, IOError) as inst:
+                if inst.args[0] != errno.EINTR:
+                    raise
+                readable = []
+            for fd in readable:
+                if self.readers.has_key(fd):
+                    self._call(self.readers[fd], fd)
+            # signals
+            while self.pendingsignals:
+                signum = self.pendingsignals.pop(0)
+                for callback in self.signalcallbacks.get(signum, []):
+                    self._call(callback, signum)
+            # timers
+            now = time.time()
+            for timer in list(self.timers):
+                if timer[0] <= now:
+                    if timer[1] is None:
+                        self.remove_timer(timer)
+                    else:
+                        timer[0] = now + timer[1]
+                    self._call(timer[2])
+        return False
+
+# Introspection of the running rotator without restarting it: a signal (SIGUSR1) starts a cProfile session and the next one stops it and dumps the stats in a file (readable with pstats), another signal (SIGUSR2) takes a snapshot of the memory allocations and reports the top allocation sites that grew since the previous snapshot
+# The signals are handled from the event loop (so the scheduler is never interrupted in the middle of a transition)
+# tracemalloc is used if available (Python 3.4+, or pytracemalloc), else the snapshot only counts the live objects by type with the garbage collector
+class Profiler(object):
+    def __init__(self, eventloop, folder, top = 20):
+        self.folder = folder
+        self.top = top
+        self.profile = None # current cProfile session
+        self.snapshot = None # previous memory snapshot (tracemalloc snapshot, or dict type name -> count)
+        eventloop.add_signal(signal.SIGUSR1, self.toggle_profile)
+        eventloop.add_signal(signal.SIGUSR2, self.memory_snapshot)
+
+    def toggle_profile(self, signum = None):
+        import cProfile, pstats, StringIO
+        if self.profile is None:
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+            print('Profiling started (send SIGUSR1 again to stop it and dump the stats).')
+            return
+        self.profile.disable()
+        path = os.path.join(self.folder, 'oa-game-rotator-'+datetime.datetime.utcnow().strftime("%Y%m%d-%H%M%S")+'.pstats')
+        self.profile.dump_stats(path)
+        output = StringIO.StringIO()
+        pstats.Stats(self.profile, stream=output).sort_stats('cumulative').print_stats(self.top)
+        self.profile = None
+        print('Profiling stopped, stats saved in '+path+'. Top functions by cumulative time:')
+        print(output.getvalue())
+
+    def memory_snapshot(self, signum = None):
+        try:
+            import tracemalloc
+        except ImportError:
+            tracemalloc = None
+        if tracemalloc is not None:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(10)
+                self.snapshot = tracemalloc.take_snapshot()
+                print('Memory tracing started (send SIGUSR2 again to see what grew since now).')
+                return
+            snapshot = tracemalloc.take_snapshot()
+            stats = snapshot.compare_to(self.snapshot, 'lineno')[:self.top]
+            self.snapshot = snapshot
+            print('Top allocation sites since the previous memory snapshot:')
+            for stat in stats:
+                print('    '+str(stat))
+        else:
+            import gc
+            counts = dict()
+            for obj in gc.get_objects():
+                name = type(obj).__name__
+                counts[name] = counts.get(name, 0) + 1
+            if self.snapshot is None:
+                self.snapshot = counts
+                print('Memory snapshot taken: '+str(sum(counts.values()))+' objects (tracemalloc is not available, only the objects are counted by type). Send SIGUSR2 again to see what grew since now.')
+                return
+            growth = sorted([(counts[name] - self.snapshot.get(name, 0), name) for name in counts], reverse=True)[:self.top]
+            self.snapshot = counts
+            print('Top growing object types since the previous memory snapshot ('+str(sum(counts.values()))+' objects now):')
+            for difference, name in growth:
+                if difference > 0:
+                    print('    '+name+': '+str(counts[name])+' (+'+str(difference)+')')
+
+# Control socket: a Unix socket served from the event loop, where each request is a line (a JSON object like {"command": "status"}, or just the command's name) and each answer a JSON line
+# Commands: status (what is running, the next deadline and the results of the last transition), reload (download and read the slotsfile again and recompile the plan now), apply (do the next transition now instead of waiting for its deadline), pause (no transition until resume) and resume
+# The waits are interrupted with the action (see EventLoop.interrupt) and main() takes it with take_action()
+class ControlServer(object):
+    def __init__(self, eventloop, path):
+        import socket
+        self.eventloop = eventloop
+        self.path = path
+        self.status = dict() # filled by main()
+        self.paused = False
+        self.clients = dict() # file descriptor -> [socket, buffer]
+        if os.path.exists(path): # left by a previous run
+            os.remove(path)
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        oldumask = os.umask(0o077) # the commands change what runs on the server, only the owner can send them (the socket is created with these permissions, so there's no window where others could connect)
+        try:
+            self.socket.bind(path)
+        finally:
+            os.umask(oldumask)
+        self.socket.listen(5)
+        self.socket.setblocking(0)
+        eventloop.add_reader(self.socket, self.accept)
+
+    def close(self):
+        self.socket.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def accept(self, fd):
+        import socket
+        try:
+            client = self.socket.accept()[0]
+        except socket.error:
+            return
+        client.setblocking(0)
+        self.clients[client.fileno()] = [client, '']
+        self.eventloop.add_reader(client, self.read)
+
+    def read(self, fd):
+        import socket
+        [client, buf] = self.clients[fd]
+        try:
+            data = client.recv(4096)
+        except socket.error:
+            data = ''
+        if not data or len(buf) > 65536: # the client closed the connection, or sends garbage
+            self.drop(fd)
+            return
+        buf += data
+        while '\n' in buf:
+            line, buf = buf.split('\n', 1)
+            if line.strip() and not self.reply(fd, self.handle(line.strip())):
+                return
+        self.clients[fd][1] = buf
+
+    def drop(self, fd):
+        self.eventloop.remove_reader(fd)
+        self.clients[fd][0].close()
+        del self.clients[fd]
+
+    # Send the answer to a client, returns False if it failed (the client is then dropped)
+    def reply(self, fd, answer):
+        import json, socket
+        client = self.clients[fd][0]
+        try:
+            client.settimeout(2) # the answers are small, but a stuck client must not block the rotator
+            client.sendall(json.dumps(answer, sort_keys=True)+'\n')
+            client.setblocking(0)
+        except socket.error:
+            self.drop(fd)
+            return False
+        return True
+
+    def handle(self, line):
+        import json
+        try:
+            request = json.loads(line) if line.startswith('{') else {'command': line}
+            command = request['command']
+        except (ValueError, KeyError) as inst:
+            return {'ok': False, 'error': 'invalid request: '+str(inst)}
+        if command == 'status':
+            status = dict(self.status)
+            status['paused'] = self.paused
+            return {'ok': True, 'status': status}
+        elif command in ['reload', 'apply']:
+            self.eventloop.interrupt(command)
+            print('Control socket: '+command+' requested.')
+        elif command == 'pause':
+            self.paused = True
+            print('Control socket: transitions paused.')
+        elif command == 'resume':
+            if self.paused:
+                self.paused = False
+                self.eventloop.interrupt('reload') # recompile the plan from now, so that the transitions missed meanwhile are not all replayed
+                print('Control socket: transitions resumed.')
+        else:
+            return {'ok': False, 'error': 'unknown command: '+str(command)+' (use status, reload, apply, pause or resume)'}
+        return {'ok': True}
+
+# Returns the action that interrupted the last wait (see EventLoop.interrupt), or None, and clear it. While the transitions are paused by the control socket, wait first until they are resumed
+def take_action(eventloop, control = None):
+    while control is not None and control.paused:
+        eventloop.run_until(time.time() + 3600)
+    action = eventloop.interrupted or None
+    eventloop.interrupted = False
+    return action
+
+# Hide the passwords in a command before it is printed (the values of the password cvars and commandline options, and of gtv_connect), empty passwords are kept since they show a public server
+def mask_passwords(command):
+    command = re.sub(r'(?i)(\w*password\s+)"[^"]+"', r'\1"***"', command)
+    return re.sub(r'(gtv_connect\s+\S+\s+)"[^"]+"', r'\1"***"', command)
+
+# Infos about the configuration running (or to run) for the status of the control socket, without the passwords
+def make_control_params(health):
+    if not health:
+        return None
+    params = dict([(key, value) for key, value in health['oampsparams'].items() if 'password' not in key])
+    params.update(dict([(key, value) for key, value in health['desired'].items() if key != 'password']))
+    params['private'] = bool(health['desired'].get('password'))
+    return params
+
+# Build the commandline to launch an ioquake3 dedicated server from the oamps parameters (used by the supervisor, instead of oamps.sh)
+def make_server_argv(oampsparams, defaultbin = 'oa_ded'):
+    argv = [oampsparams.get('binfullpath') or defaultbin, '+set', 'dedicated', '2', '+set', 'ttycon', '0'] # no tty console, so that the console commands can be sent through stdin
+    for parameter, cvar in [('basepath', 'fs_basepath'), ('homepath', 'fs_homepath'), ('gamemod', 'fs_game'), ('vmgame', 'vm_game'), ('port', 'net_port')]:
+        if oampsparams.get(parameter):
+            argv.extend(['+set', cvar, oampsparams[parameter]])
+    if oampsparams.get('config'):
+        argv.extend(['+exec', oampsparams['config']])
+    return argv
+
+# Native process supervisor: the servers are launched as child processes (instead of screen sessions through oamps.sh), and are restarted within seconds with the current slot's configuration if they crash
+# The exits are detected with SIGCHLD, the restarts are rate-limited (at most maxrestarts in restartwindow seconds, then the supervisor gives up until the next slot) and the resources usage of each process is sampled every sampleinterval seconds
+class Supervisor(object):
+    def __init__(self, eventloop, maxrestarts = 5, restartwindow = 300, restartdelay = 2, sampleinterval = 60, outputfile = None, verbose = False):
+        self.eventloop = eventloop
+        self.maxrestarts = maxrestarts
+        self.restartwindow = restartwindow
+        self.restartdelay = restartdelay
+        self.outputfile = outputfile
+        self.verbose = verbose
+        self.processes = dict() # name -> dict(argv, console commands, popen, start time, restarts times, usage)
+        eventloop.add_signal(signal.SIGCHLD, self.reap)
+        eventloop.add_timer(sampleinterval, self.sample)
+
+    def is_running(self, name):
+        return self.processes.has_key(name) and self.processes[name]['popen'] is not None
+
+    # Launch a process (stopping the previous one with the same name), and send it the console commands (one per line on stdin). The argv and commands are kept to relaunch the process if it crashes
+    def start(self, name, argv, console = None):
+        import subprocess
+        self.stop(name)
+        if self.processes.has_key(name) and self.processes[name]['argv'] == argv:
+            restarts = self.processes[name]['restarts'] # same configuration: keep the restarts history for the rate limiting
+        else:
+            restarts = []
+        process = {'argv': argv, 'console': console or [], 'popen': None, 'starttime': None, 'restarts': restarts, 'usage': None, 'failed': False}
+        self.processes[name] = process
+        if self.outputfile:
+            output = open(self.outputfile, 'a')
+        else:
+            output = open(os.devnull, 'w')
+        try:
+            process['popen'] = subprocess.Popen(argv, stdin=subprocess.PIPE, stdout=output, stderr=subprocess.STDOUT, close_fds=True)
+        except OSError as inst:
+            print('ERROR: Supervisor could not launch '+name+' ('+mask_passwords(' '.join(argv))+'). Error: '+str(inst))
+            process['failed'] = True
+            return False
+        finally:
+            output.close()
+        process['starttime'] = time.time()
+        print('Supervisor launched '+name+' (pid '+str(process['popen'].pid)+')'+(': '+mask_passwords(' '.join(argv)) if self.verbose else '.'))
+        self.send(name, process['console'])
+        return True
+
+    # Send console commands to a process (through its stdin)
+    def send(self, name, commands):
+        if not self.is_running(name) or not commands:
+            return False
+        try:
+            for command in commands:
+                self.processes[name]['popen'].stdin.write(command+'\n')
+            self.processes[name]['popen'].stdin.flush()
+        except (IOError, OSError) as inst:
+            print('ERROR: Supervisor could not send commands to '+name+'. Error: '+str(inst))
+            return False
+        return True
+
+    # Set the console commands of the current slot (that will be sent again if the process is relaunched) and send them
+    def apply(self, name, commands):
+        if self.processes.has_key(name):
+            self.processes[name]['console'] = commands
+        return self.send(name, commands)
+
+    def _close(self, process):
+        try:
+            process['popen'].stdin.close()
+        except (IOError, OSError):
+            pass
+        process['popen'] = None
+
+    # Stop a process: SIGTERM, then SIGKILL if it's still alive after timeout seconds
+    def stop(self, name, timeout = 10):
+        if not self.is_running(name):
+            return
+        process = self.processes[name]
+        popen = process['popen']
+        process['popen'] = None # so that reap() does not relaunch it
+        try:
+            popen.terminate()
+            start = time.time()
+            while popen.poll() is None and time.time() - start < timeout:
+                time.sleep(0.1)
+            if popen.poll() is None:
+                popen.kill()
+                popen.wait()
+        except OSError: # already dead
+            pass
+        process['popen'] = popen
+        self._close(process)
+        print('Supervisor stopped '+name+'.')
+
+    def stopall(self):
+        for name in self.processes.keys():
+            self.stop(name)
+
+    # Check if some processes exited (called on SIGCHLD), and relaunch them (unless they crashed too many times recently)
+    def reap(self, signum = None):
+        for name, process in self.processes.items():
+            popen = process['popen']
+            if popen is None:
+                continue
+            try:
+                pid, status, rusage = os.wait4(popen.pid, os.WNOHANG)
+            except OSError: # already reaped
+                pid, status, rusage = popen.pid, 0, None
+            if pid == 0: # still running
+                continue
+            popen.returncode = status
+            self._close(process)
+            if rusage is not None:
+                process['usage'] = {'cpu': rusage.ru_utime + rusage.ru_stime, 'maxrss': rusage.ru_maxrss}
+            print('ERROR: Supervisor: '+name+' (pid '+str(pid)+') exited with status '+str(status)+' after '+str(int(time.time() - process['starttime']))+' seconds'+(' (cpu: '+str(round(process['usage']['cpu'], 1))+' s, max rss: '+str(process['usage']['maxrss'])+' kB)' if process['usage'] else '')+'.')
+            # Restart rate limiting
+            now = time.time()
+            process['restarts'] = [t for t in process['restarts'] if now - t < self.restartwindow]
+            if len(process['restarts']) >= self.maxrestarts:
+                print('ERROR: Supervisor: '+name+' crashed '+str(len(process['restarts']))+' times in the last '+str(self.restartwindow)+' seconds, giving up until the next slot.')
+                process['failed'] = True
+                continue
+            process['restarts'].append(now)
+            self.eventloop.add_timer(self.restartdelay, lambda name=name: self._relaunch(name), once=True)
+
+    def _relaunch(self, name):
+        process = self.processes.get(name)
+        if process is None or process['popen'] is not None or process['failed']: # already relaunched (eg: by a new slot) or given up
+            return
+        print('Supervisor relaunching '+name+' with the current slot\'s configuration.')
+        restarts = process['restarts']
+        self.start(name, process['argv'], process['console'])
+        self.processes[name]['restarts'] = restarts
+
+    # Sample the resources usage of the running processes (cpu time and resident memory, from /proc)
+    def sample(self):
+        for name, process in self.processes.items():
+            if process['popen'] is None:
+                continue
+            try:
+                stat = open('/proc/'+str(process['popen'].pid)+'/stat').read()
+                fields = stat[stat.rindex(')')+2:].split() # skip the pid and the command name (which may contain spaces)
+                ticks = float(os.sysconf('SC_CLK_TCK'))
+                cpu = (int(fields[11]) + int(fields[12])) / ticks # utime + stime
+                rss = int(fields[21]) * os.sysconf('SC_PAGE_SIZE') / 1024 # in kB
+            except (IOError, OSError, ValueError, IndexError): # no /proc (not Linux) or the process just exited
+                continue
+            process['usage'] = {'cpu': cpu, 'rss': rss}
+            if self.verbose:
+                print('Supervisor: '+name+' (pid '+str(process['popen'].pid)+') cpu: '+str(round(cpu, 1))+' s, rss: '+str(rss)+' kB.')
+
+# Health check of the game server between the slots boundaries: every interval seconds, one getstatus is sent and the observed state (password set, mod, map) is compared to the desired state of the current slot
+# When they diverge, only what differs is re-applied: the password or the map by ingame commands, and the mod (or a server that does not answer anymore, maxfailures times in a row) by a hard restart, at most once per slot
+class HealthCheck(object):
+    def __init__(self, eventloop, interval, host = 'localhost', supervisor = None, maxfailures = 3, grace = 60, verbose = False, rconpassword = None):
+        self.interval = interval
+        self.host = host
+        self.supervisor = supervisor # if the game server is supervised, its crashes are managed by the supervisor and the commands are sent through it
+        self.rconpassword = rconpassword # else the ingame commands are sent by rcon if the password is known
+        self.thread = None # thread running oamps.sh to re-apply the slot (see reapply)
+        self.maxfailures = maxfailures
+        self.grace = grace # seconds to wait after a transition before checking (the server may be restarting)
+        self.verbose = verbose
+        self.health = None # see make_health_entry()
+        eventloop.add_timer(interval, self.check)
+
+    # Set the desired state of the current slot (called after each transition)
+    def set_slot(self, health):
+        self.health = health
+        self.failures = 0
+        self.restarted = False
+        self.graceuntil = time.time() + self.grace
+
+    # Wait for the end of the re-application through oamps.sh, if it's running (so that it never runs at the same time as a transition)
+    def join(self):
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def check(self):
+        if self.health is None or time.time() < self.graceuntil or (self.thread is not None and self.thread.is_alive()):
+            return
+        desired = self.health['desired']
+        status = get_server_status(self.host, self.health['port'], self.interval/2.0)
+        if status is None:
+            self.failures += 1
+            if self.failures >= self.maxfailures and self.supervisor is None and not self.restarted:
+                print('ERROR: Health check: the server on port '+str(self.health['port'])+' did not answer '+str(self.failures)+' times in a row, relaunching it with the current slot\'s configuration.')
+                self.reapply([], True)
+            return
+        self.failures = 0
+
+        # Compare the observed state with the desired state (None means unknown, so not checked)
+        commands = []
+        if desired['password'] is not None and status.has_key('g_needpass') and (status['g_needpass'] == '1') != (desired['password'] != ''):
+            commands.append('seta g_password "'+desired['password']+'"')
+        if desired['map'] and status.get('mapname') and status['mapname'].lower() != desired['map'].lower():
+            commands.append('map "'+desired['map']+'"')
+        gamename = status.get('gamename', '').lower()
+        gamemod = (desired['gamemod'] or '').lower()
+        if gamemod and gamename and gamemod not in gamename and gamename not in gamemod and self.supervisor is None and not self.restarted:
+            print('ERROR: Health check: the server on port '+str(self.health['port'])+' runs the mod '+gamename+' instead of '+gamemod+', relaunching it with the current slot\'s configuration.')
+            self.reapply([], True)
+        elif commands:
+            print('ERROR: Health check: the server on port '+str(self.health['port'])+' drifted from the current slot\'s configuration, re-applying: '+mask_passwords('; '.join(commands)))
+            self.reapply(commands)
+        elif self.verbose:
+            print('Health check: the server on port '+str(self.health['port'])+' is in the expected state.')
+
+    # Re-apply some ingame commands, or relaunch the server (with the commands of the whole desired state)
+    # This is called from the eventloop, so oamps.sh (which may take long, eg: for a restart) is run in a thread, and the ingame commands are sent through the supervisor or by rcon when possible
+    def reapply(self, commands, restart = False):
+        self.graceuntil = time.time() + self.grace # let the commands take effect before checking again
+        if restart:
+            self.restarted = True # at most once per slot, if it does not fix it there must be something else wrong
+            desired = self.health['desired']
+            if desired['password'] is not None:
+                commands.append('seta g_password "'+desired['password']+'"')
+            if desired['map']:
+                commands.append('map "'+desired['map']+'"')
+        if self.supervisor is not None:
+            self.supervisor.send('game', commands)
+        elif self.rconpassword and not restart:
+            for command in commands:
+                if q3_rcon(self.host, self.health['port'], self.rconpassword, command) is None:
+                    print('ERROR: Health check: the game server on port '+str(self.health['port'])+' did not answer to rcon '+mask_passwords(command))
+        else:
+            import threading
+            command = make_oamps_exec_command(self.health['basecommand'], self.health['oampsparams'], commands, restart, self.health['desired']['gamemod'])
+            self.thread = threading.Thread(target=execute_commands, args=([command], self.verbose, {'kind': 'health', 'port': self.health['port']}))
+            self.thread.daemon = True
+            self.thread.start()
+        if server_status_cache.has_key((self.host, str(self.health['port']))): # the state changed
+            del server_status_cache[(self.host, str(self.health['port']))]
+
+# Make the health check's part of an entry of the plan (from the infos filled by make_oamps_command): the desired state of the game server and how to reach it
+def make_health_entry(info):
+    return {'port': info['oampsparams'].get('port', '27960'), 'desired': info['desired'], 'basecommand': info['basecommand'], 'oampsparams': info['oampsparams']}
+
+# Execute a shell command, reading its stdout and stderr through pipes so that each line is written in the rotator's log as a record tagged with tags (eg: the slot, the server port and the index of the command), and also printed with the tags as prefix
+# At most maxbytes of output are kept per command (lines longer than maxline are cut), the rest is dropped and counted so that a runaway command cannot fill the log
+# The command runs in its own process group: if it is still running after timeout seconds (default: command_timeout), the whole group gets a SIGTERM, then a SIGKILL grace seconds later (default: command_kill_grace), so that a hung command (eg: a sudo prompt) cannot block the rotator
+# Returns the exit code of the command (negative if it was killed by a signal, as in subprocess), or None if it timed out
+def run_command(command, tags = None, maxbytes = 64*1024, maxline = 4096, timeout = None, grace = None):
+    import subprocess
+    if tags is None:
+        tags = dict()
+    if timeout is None:
+        timeout = command_timeout
+    if grace is None:
+        grace = command_kill_grace
+    process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True, preexec_fn=os.setsid)
+    deadline = time.time() + timeout if timeout else None
+    timedout = False
+    streams = {process.stdout.fileno(): 'stdout', process.stderr.fileno(): 'stderr'}
+    pipes = list(streams) # pipes still open
+    partial = {process.stdout.fileno(): '', process.stderr.fileno(): ''} # beginning of the current line of each pipe
+    kept = 0 # bytes of output logged
+    dropped = 0 # bytes of output dropped after maxbytes
+    while pipes:
+        if deadline is not None and time.time() >= deadline and process.poll() is None:
+            if not timedout: # first time: ask nicely
+                log_command_output('stderr', '[timeout after '+str(timeout)+' seconds: sending SIGTERM]', tags)
+                signum = signal.SIGTERM
+                deadline = time.time() + grace
+                timedout = True
+            else:
+                log_command_output('stderr', '[still running '+str(grace)+' seconds after SIGTERM: sending SIGKILL]', tags)
+                signum = signal.SIGKILL
+                deadline = None
+            try:
+                os.killpg(process.pid, signum)
+            except OSError: # the group is already gone
+                pass
+        try:
+            readable = select.select(pipes, [], [], 1)[0]
+        except select.error as inst:
+            if inst.args[0] == errno.EINTR:
+                continue
+            raise
+        if not readable and process.poll() is not None: # the command ended but a process it left in the background (eg: screen) still holds the pipes
+            pipes = []
+            readable = [fd for fd in partial if partial[fd]]
+        for fd in readable:
+            data = os.read(fd, 4096) if fd in pipes else ''
+            if data:
+                lines = (partial[fd] + data).split('\n')
+                partial[fd] = lines.pop()
+                if len(partial[fd]) > maxline: # no end of line in sight, cut the line here
+                    lines.append(partial[fd])
+                    partial[fd] = ''
+            else: # end of the output
+                lines = [partial[fd]] if partial[fd] else []
+                partial[fd] = ''
+                if fd in pipes:
+                    pipes.remove(fd)
+            for line in lines:
+                line = line.rstrip('\r')
+                if kept >= maxbytes:
+                    dropped += len(line) + 1
+                    continue
+                if len(line) > maxline:
+                    dropped += len(line) - maxline
+                    line = line[:maxline]
+                kept += len(line) + 1
+                log_command_output(streams[fd], line, tags)
+    process.stdout.close()
+    process.stderr.close()
+    returncode = process.wait()
+    if dropped:
+        log_command_output('stderr', '[output truncated: '+str(dropped)+' bytes dropped]', tags)
+    if timedout:
+        return None
+    return returncode
+
+command_timeout = 120 # default timeout of a command in seconds, 0 to disable (see run_command)
+command_kill_grace = 5 # seconds between the SIGTERM and the SIGKILL of a command that timed out
+
+# Write a line of output of a command in the rotator's log (with its tags as fields of the record) and on the terminal (with its tags as prefix)
+def log_command_output(stream, line, tags):
+    prefix = '[' + ' '.join([str(key)+'='+str(tags[key]) for key in sorted(tags)]) + '] '
+    if logwriter is not None:
+        logwriter.append(stream, line, tags)
+        terminal = getattr(sys.stdout if stream == 'stdout' else sys.stderr, 'terminal', None) # don't log it twice through LogStream
+    else:
+        terminal = sys.stdout if stream == 'stdout' else sys.stderr
+    if terminal is not None:
+        terminal.write(prefix + line + '\n')
+
+# Execute a list of commands (as returned by make_oamps_command) in a shell
+# Their output is tagged with tags (see run_command) and with the index of the command in the list
+# Returns the duration of each command (in seconds)
+def execute_commands(commands, verbose = False, tags = None, exitcodes = None):
+    durations = []
+    for index, command in enumerate(expand_commands(commands)):
+        if command: # skip None and empty commands (eg: no gtv server)
+            if verbose:
+                print(mask_passwords(command))
+            commandtags = dict(tags or dict())
+            commandtags['command'] = index
+            start = time.time()
+            returncode = run_command(command, commandtags)
+            durations.append(time.time() - start)
+            metrics.observe('oagamerotator_command_duration_seconds', durations[-1])
+            if returncode is None: # hung command: record it and go on with the next ones, the schedule must not stop
+                print('ERROR: the command timed out after '+str(round(durations[-1], 1))+' seconds and was killed: '+mask_passwords(command))
+                metrics.inc('oagamerotator_command_exit_total', code='timeout')
+            elif returncode < 0:
+                metrics.inc('oagamerotator_command_exit_total', code='signal'+str(-returncode))
+            else:
+                metrics.inc('oagamerotator_command_exit_total', code=str(returncode))
+            if exitcodes is not None: # the exit code of each command (None if it timed out)
+                exitcodes.append(returncode)
+    return durations
+
+# Tags of the output of the commands of an entry of the plan (see run_command)
+def make_entry_tags(entry):
+    tags = {'slot': entry.get('slot'), 'kind': entry.get('kind')}
+    if entry.get('health'):
+        tags['port'] = entry['health']['port']
+    return tags
+
+# Get the commandline arguments for the game server that is currently active (with hot standby, the servers swap their port and screen name at each hard restart)
+def get_active_oampsargs(oampsargs, standby = None, active = True):
+    if standby is None:
+        return oampsargs
+    serverindex = standby['active']
+    if not active:
+        serverindex = 1 - serverindex
+    oampsargs = oampsargs.copy()
+    oampsargs['port'] = [standby['ports'][serverindex]]
+    oampsargs['screenname'] = [standby['screennames'][serverindex]]
+    return oampsargs
+
+# Compile the plan of the day: the list of all the transitions that will happen from the current slot until the end of the day, with all the commands precomputed
+# This is done as soon as the slotsfile is available, so that at the slot boundary only the precomputed commands have to be executed (no parsing nor string building), and so that errors in the bookings are reported right away instead of hours later when the slot should begin
+# Returns a dict containing the date, the number of slots and the list of entries, each entry being a dict with:
+# - deadline: datetime when the entry must be executed (None for "right now")
+# - slot: the slot index (None for the end of the day, when the next day's slotsfile must be loaded)
+# - kind: 'slot' for a normal transition, 'prewarm' to launch the next slot's server in advance on the standby port, 'swap' to switch to the prewarmed server, 'end' for the end of the day
+# - commands: the commands to execute
+# - errors: the errors found in the slot
+# - waitfor: port of a server to wait for after the commands (prewarm)
+# - measure: port of a server for which the downtime is measured after the commands (hard restarts)
+# - modswitch: how the server is restarted ('hard', 'game_restart' or None, see make_oamps_command)
+# - state: the states of make_oamps_command after this entry (see get_command_state)
+# - booking: the parameters of the slot that is applied (None for the default config)
+# If gamerestart is True, mod switches are done inside the running server when possible (see make_oamps_command), except when hot standby is used
+# If standby is set (a dict with the two ports, the two screen names, the index of the active one and the lead time in seconds), the hard restarts are done by prewarming the next slot's server on the standby port before the slot begins, and swapping the servers at the slot boundary
+# Note: make_oamps_command keeps some states between calls (eg: last binary used), so the entries must be compiled in the same order they will be executed
+# these states are saved in each entry (state) and only set when the entry is executed (see execute_plan_entry), so that a plan compiled again in the middle of the day starts from the last executed slot, not from the end of the previous plan
+def compile_dayplan(nbslots, slots, defaultconfig, defaultmod, oampsarguments, startup = False, oampsfullpath = None, timedelimiter = ":", margindelay = 0, cfgfolder = None, gtvcfgfolder = None, standby = None, gamerestart = False, supervise = False):
+    [currslot, nextslot, nexttime, nexttimestr, sleeptime] = get_slots_time_infos(nbslots, timedelimiter, margindelay)
+    [d, today, currtime] = get_today(timedelimiter, margindelay)
+    daystart = datetime.datetime.strptime(today, "%Y-%m-%d")
+    minutes_per_slot = 1440/nbslots
+
+    plan = {'date': today, 'nbslots': nbslots, 'entries': []}
+    if 1440 % nbslots != 0:
+        print('ERROR: the number of slots ('+str(nbslots)+') does not divide a day in a round number of minutes, slots will drift from the expected times.')
+
+    if standby is not None: # the servers are swapped when the swap entries are executed (see execute_plan_entry), here we only follow which one will be active at each entry
+        active = standby['active']
+    realstate = get_command_state()
+    realgtvstate = get_gtv_state()
+    previousdeadline = datetime.datetime.utcnow()
+    for slotindex in range(currslot, nbslots):
+        # The current slot is applied right now, the others at their start time (plus the margin delay)
+        if slotindex == currslot:
+            deadline = None
+        else:
+            deadline = daystart + datetime.timedelta(minutes=slotindex*minutes_per_slot, seconds=margindelay)
+
+        errors = []
+        if slotindex >= len(slots): # should not happen since read_slotsfile initialize all the slots, but it costs nothing to check
+            slot = None
+        else:
+            slot = slots[slotindex]
+        if slot is not None and not isinstance(slot, dict): # an empty slot line
+            slot = None
+
+        # Hot standby: a hard restart (but not at startup, nor if the slot sets its own port or screen) is done by launching the new server on the standby port before the slot begins
+        liveport = get_active_oampsargs(oampsarguments, standby).get('port') # port of the server running before this slot (where the players are)
+        usestandby = (standby is not None and deadline is not None and not startup and slot is not None
+                      and slot.has_key('restart_hard') and not slot.has_key('port') and not slot.has_key('screenname'))
+        slotargs = get_active_oampsargs(oampsarguments, standby, active=not usestandby)
+
+        booking = slot
+        info = dict()
+        previousstate = get_command_state()
+        previousgtvstate = get_gtv_state()
+        compilestart = time.time()
+        try:
+            commands = make_oamps_command(defaultconfig, defaultmod, slotargs, slot, startup, oampsfullpath, cfgfolder, gtvcfgfolder, info, gamerestart and not usestandby, gtvfollow=usestandby) # the GTV server must follow the game to the standby port
+        except Exception as inst:
+            # Bad booking: we report it now and fallback to the default config for this slot
+            set_command_state(previousstate) # forget what the bad booking already changed (eg: its mod)
+            set_gtv_state(previousgtvstate)
+            errors.append('invalid slot '+str(slotindex)+' ('+str(slot)+'): '+str(inst))
+            usestandby = False
+            booking = None
+            slotargs = get_active_oampsargs(oampsarguments, standby)
+            commands = make_oamps_command(defaultconfig, defaultmod, slotargs, None, startup, oampsfullpath, cfgfolder, gtvcfgfolder, info)
+        startup = False # only the first entry can be a startup
+        timings = {'compile': time.time() - compilestart}
+
+        for error in errors:
+            print('ERROR: '+error+' - the default config will be loaded instead for this slot.')
+
+        if usestandby:
+            # Prewarm: launch the game server on the standby port (the GTV commands, which reconnect the GTV server to the new port, will be sent at the swap)
+            newport = slotargs['port'][0]
+            oldscreenname = get_active_oampsargs(oampsarguments, standby)['screenname'][0]
+            prewarmdeadline = max(previousdeadline, deadline - datetime.timedelta(seconds=standby['lead']))
+            plan['entries'].append({'deadline': prewarmdeadline, 'slot': slotindex, 'kind': 'prewarm', 'commands': commands[:info['nbgamecommands']], 'errors': errors, 'waitfor': newport, 'timings': timings,
+                                    'state': previousstate}) # the players are still on the previous slot's server
+            # Swap: redirect the GTV server to the new server and stop the old one (the new one is already registered on the master server since it was launched)
+            swapcommands = commands[info['nbgamecommands']:] + ['screen -S "'+oldscreenname+'" -X quit']
+            plan['entries'].append({'deadline': deadline, 'slot': slotindex, 'kind': 'swap', 'commands': swapcommands, 'errors': [], 'measure': newport, 'modswitch': 'standby', 'health': make_health_entry(info), 'liveport': liveport[0] if liveport else '27960', 'timings': dict(),
+                                       'countdown': info['countdown'], 'countdownmessage': info['countdownmessage'], 'state': get_command_state(), 'booking': booking})
+            standby['active'] = 1 - standby['active'] # the next entries are compiled for the new server (restored at the end: the swap really happens when the entry is executed)
+        else:
+            entry = {'deadline': deadline, 'slot': slotindex, 'kind': 'slot', 'commands': commands, 'errors': errors, 'modswitch': info['modswitch'], 'health': make_health_entry(info), 'liveport': liveport[0] if liveport else '27960', 'timings': timings,
+                     'countdown': info['countdown'], 'countdownmessage': info['countdownmessage'], 'state': get_command_state(), 'booking': booking}
+            if supervise: # the game server is managed by the supervisor, only the GTV commands go through oamps.sh
+                entry['commands'] = commands[info['nbgamecommands']:]
+                entry['supervise'] = make_supervise_entry(info)
+            if info['modswitch'] and slotargs.get('port'):
+                entry['measure'] = slotargs['port'][0]
+            plan['entries'].append(entry)
+        if deadline is not None:
+            previousdeadline = deadline
+
+    # Last entry: the end of the day, when the next day's slotsfile must be loaded
+    plan['entries'].append({'deadline': daystart + datetime.timedelta(days=1, seconds=margindelay), 'slot': None, 'kind': 'end', 'commands': [], 'errors': []})
+
+    if standby is not None:
+        standby['active'] = active
+    set_command_state(realstate)
+    set_gtv_state(realgtvstate) # the GTV commands were precompiled, the GTV server's connections change when they are executed
+
+    return plan
+
+# Convert a plan of the day to a JSON string (for inspection)
+def dayplan_to_json(plan):
+    import json
+    entries = []
+    for entry in plan['entries']:
+        entry = entry.copy()
+        if entry['deadline'] is not None:
+            entry['deadline'] = entry['deadline'].strftime("%Y-%m-%d %H:%M:%S")
+        entries.append(entry)
+    return json.dumps({'date': plan['date'], 'nbslots': plan['nbslots'], 'entries': entries}, indent=4)
+
+# Make the supervisor's part of an entry of the plan (from the infos filled by make_oamps_command): the game server's commandline, if it must be restarted and its console commands
+def make_supervise_entry(info):
+    serverparams = info['oampsparams'].copy()
+    if info['gamemod']: # the mod that will be running (the last one if the slot doesn't set one)
+        serverparams['gamemod'] = info['gamemod']
+    return {'argv': make_server_argv(serverparams), 'restart': info['restart'], 'console': info['console']}
+
+# Apply the supervisor's part of an entry of the plan: (re)launch the game server if needed, else send it the console commands
+# note: without a restart, the commandline of the last launch is kept for the relaunches (the slot's commandline may not be complete, eg: no config, since the server keeps running with the previous one)
+def apply_supervise_entry(supervise, supervisor, name = 'game'):
+    if supervise['restart'] or not supervisor.is_running(name):
+        supervisor.start(name, supervise['argv'], supervise['console'])
+    else:
+        supervisor.apply(name, supervise['console'])
+
+# Execute an entry of the plan of the day
+# The states of make_oamps_command are set to the ones saved in the entry, and with hot standby the active server is switched when a swap entry is executed (so a plan compiled again in the middle of the day starts from what is really running)
+def execute_plan_entry(entry, verbose = False, servertimeout = 60, supervisor = None, standby = None):
+    if entry['kind'] == 'prewarm':
+        print('Prewarming the standby server on port '+str(entry['waitfor'])+' for slot '+str(entry['slot'])+'.')
+    elif entry['kind'] == 'swap':
+        print('Swapping to the standby server on port '+str(entry['measure'])+' for slot '+str(entry['slot'])+'.')
+    elif entry['slot'] is not None:
+        print('Applying slot '+str(entry['slot'])+'.')
+    start = time.time()
+    timings = entry.setdefault('timings', dict()) # durations of the phases of the transition (see TransitionTimings)
+    if entry.get('supervise') and supervisor is not None:
+        apply_supervise_entry(entry['supervise'], supervisor)
+        timings['supervise'] = time.time() - start
+    entry['exitcodes'] = []
+    timings['commandsdurations'] = execute_commands(entry['commands'], verbose, make_entry_tags(entry), entry['exitcodes'])
+    timings['commands'] = sum(timings['commandsdurations'])
+    if entry['kind'] == 'swap' and standby is not None:
+        standby['active'] = 1 - standby['active']
+    if entry.get('state'): # what is running now (see compile_dayplan)
+        set_command_state(entry['state'])
+
+    # Prewarm: wait for the standby server to answer before the slot begins
+    if entry.get('waitfor'):
+        waited = wait_for_server('localhost', entry['waitfor'], servertimeout)
+        if waited is None:
+            print('ERROR: the standby server on port '+str(entry['waitfor'])+' did not answer after '+str(servertimeout)+' seconds, the swap will still happen at the slot boundary.')
+        else:
+            print('The standby server on port '+str(entry['waitfor'])+' is ready (started in '+str(round(waited, 1))+' seconds).')
+        timings['waitfor'] = waited
+    # Hard restart or swap: measure the downtime (time from the beginning of the transition until the server answers again)
+    if entry.get('measure'):
+        downtime = wait_for_server('localhost', entry['measure'], servertimeout, start)
+        if downtime is None:
+            print('ERROR: the server on port '+str(entry['measure'])+' did not answer '+str(servertimeout)+' seconds after the transition.')
+        else:
+            print('Transition downtime for slot '+str(entry['slot'])+' (restart by '+str(entry.get('modswitch'))+'): '+str(round(downtime, 1))+' seconds.')
+        entry['downtime'] = downtime
+        timings['downtime'] = downtime
+
+# Timings of the transitions: for each transition, the durations of its phases (download and reading of the slotsfile, building of the commands, each command, waits) and its planned and actual start times are emitted as one JSON record (printed, and appended to a file if path is set)
+# The durations of the last window transitions are kept per phase, to show rolling percentiles
+class TransitionTimings(object):
+    def __init__(self, path = None, window = 100):
+        self.path = path
+        self.window = window
+        self.samples = dict() # phase -> durations of the last transitions
+
+    # Emit the record of a transition (an entry of the plan, executed at actual, a timestamp) with the phases of the cycle before it (eg: download)
+    def record(self, entry, actual, cyclephases = None):
+        import json, collections
+        phases = dict(cyclephases or {})
+        for phase, duration in entry.get('timings', {}).items():
+            if isinstance(duration, (int, long, float)):
+                phases[phase] = duration
+        record = {'time': round(actual, 3), 'slot': entry.get('slot'), 'kind': entry.get('kind'),
+                  'phases': dict([(phase, round(duration, 4)) for phase, duration in phases.items()]),
+                  'commands': [round(duration, 4) for duration in entry.get('timings', {}).get('commandsdurations', [])]}
+        if entry.get('deadline') is not None:
+            record['planned'] = round(utc_to_timestamp(entry['deadline']), 3)
+            phases['lateness'] = record['phases']['lateness'] = round(actual - record['planned'], 4) # time between the planned start and the actual start of the transition
+            metrics.observe('oagamerotator_transition_lateness_seconds', max(0, phases['lateness']))
+        metrics.set('oagamerotator_current_slot', entry.get('slot') if entry.get('slot') is not None else -1)
+        for phase, duration in phases.items():
+            if phase not in self.samples:
+                self.samples[phase] = collections.deque(maxlen=self.window)
+            self.samples[phase].append(duration)
+        line = json.dumps(record, sort_keys=True)
+        print('Transition timings: '+line)
+        if self.path:
+            try:
+                f = open(self.path, 'a')
+                f.write(line+'\n')
+                f.close()
+            except IOError as inst:
+                print('ERROR: the transition timings could not be written in '+self.path+'. Error: '+str(inst))
+        return record
+
+    # Rolling percentiles (p50, p90, p99 and max) of a phase, in seconds
+    def percentiles(self, phase):
+        values = sorted(self.samples.get(phase, []))
+        if not values:
+            return None
+        return dict([('p'+str(pct), values[min(len(values)-1, int(len(values) * pct / 100.0))]) for pct in [50, 90, 99]] + [('max', values[-1])])
+
+    def summary(self):
+        lines = []
+        for phase in sorted(self.samples.keys()):
+            pcts = self.percentiles(phase)
+            lines.append(phase+' '+'/'.join([str(round(pcts[key], 3)) for key in ['p50', 'p90', 'p99', 'max']]))
+        return 'Transition timings over the last '+str(self.window)+' transitions (p50/p90/p99/max in seconds): '+', '.join(lines)
+
+# Journal of the transitions: an append-only JSON lines file with one record per transition (what was applied on the server, when, how long each phase took and the exit code of each command), never rewritten except by compact()
+# A small sidecar index (path + '.idx', one "timestamp offset" line every indexbytes bytes of journal) allows to find the records around a time without scanning the whole file (see journal_main)
+class Journal(object):
+    def __init__(self, path, indexbytes = 64*1024):
+        self.path = path
+        self.indexpath = path + '.idx'
+        self.indexbytes = indexbytes
+        self.lastindexed = None # offset of the last indexed record
+        lock = self.lock()
+        try:
+            index = self.read_index()
+            if index and os.path.exists(path) and index[-1][1] < os.path.getsize(path):
+                self.lastindexed = index[-1][1]
+            elif os.path.exists(path) and os.path.getsize(path) > 0: # no index or stale index (eg: the journal was truncated by hand)
+                self.rebuild_index()
+        finally:
+            lock.close()
+
+    # Lock the journal (through a sidecar file, since compact() replaces the journal file) so that a record is never appended while the journal is compacted by another process, returns the file to close to unlock it
+    def lock(self):
+        import fcntl
+        f = open(self.path + '.lock', 'a')
+        fcntl.lockf(f, fcntl.LOCK_EX)
+        return f
+
+    # Append the record of a transition (as returned by TransitionTimings.record) with the infos of the entry of the plan
+    def record(self, record, entry, server = None):
+        import json
+        record = dict(record)
+        record['server'] = server
+        record['exits'] = entry.get('exitcodes', [])
+        if entry.get('health'):
+            record['port'] = entry['health']['port']
+            record['map'] = entry['health']['desired'].get('map')
+            record['gamemod'] = entry['health']['desired'].get('gamemod')
+        if entry.get('errors'):
+            record['errors'] = entry['errors']
+        if entry.get('downtime') is not None:
+            record['downtime'] = round(entry['downtime'], 3)
+        try:
+            lock = self.lock()
+            try:
+                index = self.read_index() # the journal may have been compacted since the last record
+                self.lastindexed = index[-1][1] if index else None
+                f = open(self.path, 'a')
+                f.seek(0, os.SEEK_END)
+                offset = f.tell()
+                f.write(json.dumps(record, sort_keys=True)+'\n')
+                f.flush()
+                os.fsync(f.fileno()) # the transitions are rare, so each record can be made durable
+                f.close()
+                if self.lastindexed is None or offset - self.lastindexed >= self.indexbytes:
+                    f = open(self.indexpath, 'a')
+                    f.write(repr(record['time'])+' '+str(offset)+'\n')
+                    f.close()
+                    self.lastindexed = offset
+            finally:
+                lock.close()
+        except (IOError, OSError) as inst:
+            print('ERROR: the transition could not be written in the journal '+self.path+'. Error: '+str(inst))
+
+    # Returns the index as a list of [timestamp, offset], sorted
+    def read_index(self):
+        index = []
+        try:
+            f = open(self.indexpath, 'r')
+            for line in f:
+                fields = line.split()
+                if len(fields) == 2: # skip a line being written
+                    index.append([float(fields[0]), int(fields[1])])
+            f.close()
+        except IOError: # no index yet
+            pass
+        except ValueError as inst:
+            print('ERROR: the index of the journal '+self.indexpath+' is corrupted, it will be rebuilt. Error: '+str(inst))
+            return []
+        return index
+
+    def rebuild_index(self):
+        offsets = []
+        for offset, record in self.scan():
+            if not offsets or offset - offsets[-1][1] >= self.indexbytes:
+                offsets.append([record['time'], offset])
+        f = open(self.indexpath + '.tmp', 'w')
+        for timestamp, offset in offsets:
+            f.write(repr(timestamp)+' '+str(offset)+'\n')
+        f.close()
+        os.rename(self.indexpath + '.tmp', self.indexpath)
+        self.lastindexed = offsets[-1][1] if offsets else None
+
+    # Iterate over the records (with their offset) from the given offset, skipping the lines that can't be read (eg: a record being written)
+    def scan(self, offset = 0):
+        import json
+        try:
+            f = open(self.path, 'r')
+        except IOError:
+            return
+        f.seek(offset)
+        while True:
+            line = f.readline()
+            if not line:
+                break
+            try:
+                yield [offset, json.loads(line)]
+            except ValueError:
+                pass
+            offset += len(line)
+        f.close()
+
+    # Offset from which to scan to find the records after timestamp (the last indexed record before it), and its position in the index
+    def seek_offset(self, timestamp, index = None):
+        import bisect
+        if index is None:
+            index = self.read_index()
+        i = bisect.bisect_right([indexed[0] for indexed in index], timestamp) - 1
+        return [index[i][1] if i >= 0 else 0, i]
+
+    # Records between since and until (timestamps, None for no limit)
+    def between(self, since = None, until = None):
+        for offset, record in self.scan(self.seek_offset(since)[0] if since is not None else 0):
+            if until is not None and record['time'] > until:
+                break
+            if since is None or record['time'] >= since:
+                yield record
+
+    # What was running at timestamp: the last transition applying a configuration before it (the prewarms and the ends of the days don't change what is running)
+    def at(self, timestamp):
+        index = self.read_index()
+        [offset, i] = self.seek_offset(timestamp, index)
+        while True:
+            running = None
+            for offset, record in self.scan(offset):
+                if record['time'] > timestamp:
+                    break
+                if record.get('kind') in ['slot', 'swap', 'idle']:
+                    running = record
+            if running is not None or i <= 0:
+                return running
+            # only prewarms since the indexed record, look in the previous part of the journal
+            i -= 1
+            offset = index[i][1]
+
+    # Rewrite the journal without the records older than before (a timestamp), except the last applied one so that at() still works right after it, and rebuild the index
+    # Returns the number of records removed
+    def compact(self, before):
+        lock = self.lock()
+        try:
+            return self._compact(before)
+        finally:
+            lock.close()
+
+    def _compact(self, before):
+        import json
+        kept = []
+        removed = 0
+        last = None # last transition applying a configuration before the cut
+        for offset, record in self.scan():
+            if record['time'] < before:
+                removed += 1
+                if record.get('kind') in ['slot', 'swap', 'idle']:
+                    last = record
+            else:
+                kept.append(record)
+        if last is not None:
+            kept.insert(0, last)
+            removed -= 1
+        f = open(self.path + '.tmp', 'w')
+        for record in kept:
+            f.write(json.dumps(record, sort_keys=True)+'\n')
+        f.close()
+        os.rename(self.path + '.tmp', self.path) # atomic replace, the journal is never half written
+        self.rebuild_index()
+        return removed
+
+# History of the match ends relative to the slots boundaries, as a compact histogram per mod and gametype (bins of binsize seconds, the last bin counting everything above), saved in a JSON file
+# It is used to pick a margin delay that lets most matches finish (a target percentile of them) without wasting the beginning of the next slot
+# The matches still running when the wait was cut (censored) are kept in a separate histogram: their end is only known to be after the cut
+# The samples decay at each record of the same key (the weight of a sample is multiplied by decay), so that the history follows the recent matches and the margin can come back down
+class MatchHistory(object):
+    def __init__(self, path, maximum = 600, binsize = 15, percentile = 90, minsamples = 10, decay = 0.95):
+        self.path = path
+        self.maximum = maximum # maximum margin delay
+        self.binsize = binsize
+        self.percentile = percentile
+        self.minsamples = minsamples # below, the history is not representative and the fixed margin delay is used (with the decay, there are at most 1/(1-decay) samples)
+        self.decay = decay
+        self.histograms = dict()
+        self.censored = dict() # per key, histogram of the lower bounds of the matches not finished at the cut
+        try:
+            import json
+            f = open(path, 'r')
+            data = json.load(f)
+            f.close()
+            if data.get('binsize') == binsize:
+                self.histograms = data['histograms']
+                self.censored = data.get('censored', dict())
+            else:
+                print('ERROR: the match history '+path+' uses bins of '+str(data.get('binsize'))+' seconds, it is reset.')
+        except IOError: # no history yet
+            pass
+        except ValueError as inst:
+            print('ERROR: the match history '+path+' could not be read, it is reset. Error: '+str(inst))
+
+    # Record a match end, seconds after the boundary, or a lower bound of it if the match was not finished yet (censored)
+    def record(self, key, seconds, censored = False):
+        nbbins = int(math.ceil(self.maximum / float(self.binsize))) + 1
+        for histograms in [self.histograms, self.censored]:
+            histogram = histograms.setdefault(key, [])
+            histogram.extend([0] * (nbbins - len(histogram)))
+            histogram[:] = [round(nb * self.decay, 6) for nb in histogram]
+        histogram = self.censored[key] if censored else self.histograms[key]
+        histogram[min(int(seconds // self.binsize), nbbins - 1)] += 1
+        self.save()
+
+    # Margin delay covering the target percentile of the matches (or None if there are not enough samples)
+    # A censored match is counted as ending in the bin after its lower bound: if the matches are often cut, the margin grows one bin at a time
+    def margin(self, key):
+        histogram = self.histograms.get(key) or []
+        censored = self.censored.get(key) or []
+        total = sum(histogram) + sum(censored)
+        if total == 0 or total < self.minsamples:
+            return None
+        target = total * self.percentile / 100.0
+        count = 0
+        for i in range(max(len(histogram), len(censored) + 1)):
+            count += (histogram[i] if i < len(histogram) else 0) + (censored[i-1] if 0 < i <= len(censored) else 0)
+            if count >= target - 1e-9:
+                break
+        return min((i+1) * self.binsize, self.maximum)
+
+    def save(self):
+        import json
+        try:
+            f = open(self.path + '.tmp', 'w')
+            json.dump({'binsize': self.binsize, 'histograms': self.histograms, 'censored': self.censored}, f)
+            f.close()
+            os.rename(self.path + '.tmp', self.path) # atomic replace, the history is never half written
+        except (IOError, OSError) as inst:
+            print('ERROR: the match history could not be saved in '+self.path+'. Error: '+str(inst))
+
+# Key of the histogram of the match running on a server (mod and gametype, from its status)
+def match_history_key(status):
+    if status is None:
+        return 'unknown'
+    return status.get('gamename', 'unknown').lower() + '/' + status.get('g_gametype', '?')
+
+# Player-aware transition: wait from the slot boundary (the deadline minus the margin delay) until the match ends (up to cap seconds), instead of always waiting the whole margin delay
+# If the server is empty, the transition happens right at the boundary. If the server does not answer, the fixed margin delay is used
+# If a history is given (see MatchHistory), the match end is recorded when the booking changes at this boundary (changed), and without playeraware the margin delay is the one learned from the history
+# Returns the reason of the transition (see wait_for_match_end)
+def playerwait(entry, margindelay, cap, eventloop = None, gamelog = None, history = None, playeraware = True, changed = True):
+    boundary = entry['deadline'] - datetime.timedelta(seconds=margindelay)
+    planwait(boundary, eventloop)
+    if eventloop is not None and eventloop.interrupted:
+        return 'interrupted'
+    margin = margindelay
+    if history is not None:
+        key = match_history_key(get_server_status('localhost', entry['liveport'], 5))
+        learned = history.margin(key)
+        if learned is not None:
+            margin = learned
+            print('Learned margin delay for '+key+' matches: '+str(learned)+' seconds ('+str(history.percentile)+'th percentile).')
+        if not playeraware:
+            cap = margin
+    [waited, reason] = wait_for_match_end('localhost', entry['liveport'], cap, eventloop=eventloop, gamelog=gamelog)
+    if reason == 'interrupted':
+        return reason
+    # only the matches that were really played until the transition are learned (not an empty server nor players leaving, which would count as 0 seconds), and only if the booking changes (else the match just goes on in the next slot)
+    if history is not None and changed and reason in ['match end in the log', 'map changed', 'new match', 'cap reached']:
+        history.record(key, waited, censored=(reason == 'cap reached')) # a match not finished yet is only known to need more than waited
+    if not playeraware:
+        planwait(boundary + datetime.timedelta(seconds=margin), eventloop)
+        entry['marginsaved'] = margindelay - margin
+        return 'margin delay'
+    if waited is None:
+        print('The server on port '+str(entry['liveport'])+' did not answer, using the fixed margin delay.')
+        planwait(entry['deadline'], eventloop)
+        return reason
+    print('Player-aware transition for slot '+str(entry['slot'])+': '+reason+' after '+str(int(waited))+' seconds, '+str(int(margindelay - waited))+' seconds saved on the margin delay ('+str(margindelay)+' seconds).')
+    entry['marginsaved'] = margindelay - waited
+    return reason
+
+# Send ingame commands to the game server currently running (the one whose slot's health entry is given, see make_health_entry): through the supervisor if it's supervised, else by rcon if the rcon password is known, else through oamps.sh
+def send_ingame_commands(commands, health, supervisor = None, rconpassword = None, verbose = False):
+    if supervisor is not None:
+        supervisor.send('game', commands)
+    elif rconpassword and health is not None:
+        for command in commands:
+            if q3_rcon('localhost', health['port'], rconpassword, command) is None:
+                print('ERROR: the game server on port '+str(health['port'])+' did not answer to rcon '+mask_passwords(command))
+    elif health is not None:
+        execute_commands([make_oamps_exec_command(health['basecommand'], health['oampsparams'], commands)], verbose, {'kind': 'ingame', 'port': health['port']})
+    else:
+        print('ERROR: no way to send the commands to the game server: '+mask_passwords('; '.join(commands)))
+
+# Format a duration for the players (eg: 5 minutes, 30 seconds)
+def format_duration(seconds):
+    if seconds >= 60 and seconds % 60 == 0:
+        return str(seconds/60) + ' minute' + ('s' if seconds > 60 else '')
+    return str(seconds) + ' second' + ('s' if seconds > 1 else '')
+
+# Countdown before a transition: the players are warned (say and centerprint) at each offset (in seconds) before the deadline, then we wait until the exact deadline of the transition
+def countdownwait(deadline, countdown, message, offsets, send, eventloop = None):
+    if not message:
+        message = 'The next booking begins in'
+    for offset in sorted(set([countdown] + [o for o in offsets if o < countdown]), reverse=True):
+        warntime = deadline - datetime.timedelta(seconds=offset)
+        if datetime.datetime.utcnow() > warntime + datetime.timedelta(seconds=1): # too late for this one
+            continue
+        if eventloop is not None:
+            while not eventloop.run_until(utc_to_timestamp(warntime)) and not eventloop.interrupted:
+                pass
+            if eventloop.interrupted:
+                return
+        else:
+            time.sleep(max(0, utc_to_timestamp(warntime) - time.time()))
+        text = message + ' ' + format_duration(offset)
+        send(['say "'+text+'"', 'cp "'+text+'"'])
+    planwait(deadline, eventloop)
+
+# Wait until the deadline of the next entry of the plan of the day (running the eventloop meanwhile if given)
+def planwait(deadline, eventloop = None):
+    print('Sleeping until '+deadline.strftime("%Y-%m-%d %H:%M:%S")+' UTC')
+    if eventloop is not None:
+        while not eventloop.run_until(utc_to_timestamp(deadline)) and not eventloop.interrupted: # the loop may be stopped by a callback, but we still wait for the deadline (unless the wait is interrupted)
+            pass
+        return
+    while (datetime.datetime.utcnow() < deadline):
+        remaining = deadline - datetime.datetime.utcnow()
+        time.sleep(max(0.01, remaining.days*86400 + remaining.seconds + remaining.microseconds/1000000.0 + 0.01)) # small extra delay because the sleep function may not be exact and wake up a bit earlier
+    return
 
 
 
@@ -593,9 +2953,145 @@ def make_oamps_command(defaultconfig, defaultmod, oampsarguments, slot = None, s
 #                       MAIN
 #***********************************
 
+# Parse a time given at commandline for the journal: a UTC date ("2014-03-20", "2014-03-20 18:30" or "2014-03-20 18:30:00"), "now" or a duration before now ("30m", "12h", "7d")
+def parse_journal_time(text):
+    text = text.strip()
+    if text == 'now':
+        return time.time()
+    units = {'m': 60, 'h': 3600, 'd': 86400}
+    if text[-1:] in units and text[:-1].isdigit():
+        return time.time() - int(text[:-1]) * units[text[-1]]
+    for dateformat in ["%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%d"]:
+        try:
+            return utc_to_timestamp(datetime.datetime.strptime(text, dateformat))
+        except ValueError:
+            pass
+    raise argparse.ArgumentTypeError('invalid time: '+text+' (use eg: "2014-03-20 18:30", "now" or "7d")')
+
+# Format a record of the journal for the journal subcommand
+def format_journal_record(record):
+    line = datetime.datetime.utcfromtimestamp(record['time']).strftime("%Y-%m-%d %H:%M:%S")+' UTC '+str(record.get('kind'))
+    for key in ['slot', 'server', 'port', 'gamemod', 'map']:
+        if record.get(key) is not None:
+            line += ' '+key+'='+str(record[key])
+    line += ' exits='+','.join([str(code) for code in record.get('exits', [])])
+    if record.get('phases', {}).get('lateness') is not None:
+        line += ' late='+str(record['phases']['lateness'])+'s'
+    if record.get('downtime') is not None:
+        line += ' downtime='+str(record['downtime'])+'s'
+    return line
+
+# Journal subcommand: query or compact a journal written with --journal (eg: oa-game-rotator.py journal /some/journal.jsonl --at "2014-03-20 18:30")
+def journal_main(argv):
+    import json
+    parser = argparse.ArgumentParser(prog='oa-game-rotator.py journal', description='Query or compact a journal of the transitions written with --journal. The times are in UTC, eg: "2014-03-20 18:30", "now", or a duration before now like "30m", "12h" or "7d".')
+    parser.add_argument('journal', metavar='/some/journal.jsonl', type=str, help='Path to the journal.')
+    parser.add_argument('--at', metavar='time', type=parse_journal_time, required=False, help='Show what was running at this time.')
+    parser.add_argument('--since', metavar='time', type=parse_journal_time, required=False, help='Show the transitions since this time (eg: 7d for the last week).')
+    parser.add_argument('--until', metavar='time', type=parse_journal_time, required=False, help='Show the transitions until this time.')
+    parser.add_argument('--compact', metavar='time', type=parse_journal_time, required=False, help='Remove the records older than this time (eg: 30d), except the last transition before it.')
+    parser.add_argument('--json', action='store_true', default=False, help='Print the records as JSON lines instead of a summary.')
+    args = parser.parse_args(argv)
+
+    if not os.path.exists(args.journal):
+        print('ERROR: the journal '+args.journal+' does not exist.')
+        return 1
+    journal = Journal(fullpath(args.journal))
+    def show(record):
+        if args.json:
+            print(json.dumps(record, sort_keys=True))
+        else:
+            print(format_journal_record(record))
+    if args.compact is not None:
+        removed = journal.compact(args.compact)
+        print('Removed '+str(removed)+' records from the journal.')
+    elif args.at is not None:
+        record = journal.at(args.at)
+        if record is None:
+            print('Nothing was applied before this time in the journal.')
+            return 1
+        show(record)
+    else:
+        for record in journal.between(args.since, args.until):
+            show(record)
+    return 0
+
+# Ctl subcommand: send a command to a running rotator through its control socket (see --control-socket) and print the answer (eg: oa-game-rotator.py ctl /some/rotator.sock status)
+def ctl_main(argv):
+    import json, socket
+    parser = argparse.ArgumentParser(prog='oa-game-rotator.py ctl', description='Send a command to a running rotator through its control socket (see --control-socket).')
+    parser.add_argument('socket', metavar='/some/rotator.sock', type=str, help='Path to the control socket.')
+    parser.add_argument('command', choices=['status', 'reload', 'apply', 'pause', 'resume'], help='status: what is running and what is next, reload: read the slotsfile again now, apply: do the next transition now, pause/resume: stop/restart doing the transitions.')
+    args = parser.parse_args(argv)
+
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.settimeout(10)
+    try:
+        client.connect(args.socket)
+        client.sendall(json.dumps({'command': args.command})+'\n')
+        answer = ''
+        while not answer.endswith('\n'):
+            data = client.recv(4096)
+            if not data:
+                break
+            answer += data
+        client.close()
+        answer = json.loads(answer)
+    except (socket.error, ValueError) as inst:
+        print('ERROR: no answer from the rotator on '+args.socket+'. Error: '+str(inst))
+        return 1
+    if not answer.get('ok'):
+        print('ERROR: '+str(answer.get('error')))
+        return 1
+    if args.command == 'status':
+        print(json.dumps(answer['status'], sort_keys=True, indent=4))
+    else:
+        print('OK')
+    return 0
+
+# Board subcommand: show the state of all the rotators publishing in a status board (see --status-board), eg: oa-game-rotator.py board /tmp/oa-game-rotator.board --watch 5
+def board_main(argv):
+    import json
+    parser = argparse.ArgumentParser(prog='oa-game-rotator.py board', description='Show the state of all the rotators publishing in a status board (see --status-board).')
+    parser.add_argument('board', metavar='/some/status.board', type=str, help='Path to the status board.')
+    parser.add_argument('--watch', metavar='seconds', type=float, required=False, help='Show the board again every few seconds, until interrupted.')
+    parser.add_argument('--json', action='store_true', default=False, help='Print the records as JSON lines instead of a table.')
+    args = parser.parse_args(argv)
+
+    while True:
+        try:
+            records = read_status_board(args.board)
+        except (IOError, OSError, struct.error) as inst:
+            print('ERROR: the status board '+args.board+' could not be read. Error: '+str(inst))
+            return 1
+        now = time.time()
+        if args.json:
+            for record in records:
+                print(json.dumps(record, sort_keys=True))
+        else:
+            print('%-32s %7s %-6s %-8s %-20s %8s %8s %s' % ('SERVER', 'PID', 'SLOT', 'KIND', 'NEXT (UTC)', 'LATE', 'UPDATED', 'FLAGS'))
+            for record in sorted(records, key=lambda record: record['name']):
+                print('%-32s %7d %-6s %-8s %-20s %7.3fs %7ds %s' % (record['name'], record['pid'], record['slot'] if record['slot'] is not None else '-', record['kind'] or '-',
+                      datetime.datetime.utcfromtimestamp(record['deadline']).strftime("%Y-%m-%d %H:%M:%S") if record['deadline'] else '-',
+                      record['lateness'], int(now - record['updated']), ','.join(record['flags']) or 'ok'))
+        if not args.watch:
+            return 0
+        try:
+            time.sleep(args.watch)
+        except KeyboardInterrupt:
+            return 0
+        print('')
+
 def main(argv=None):
+    global logwriter, command_timeout, command_kill_grace
     if argv is None:
         argv = sys.argv[1:]
+    if argv and argv[0] == 'journal': # subcommand to query the journal
+        return journal_main(argv[1:])
+    if argv and argv[0] == 'ctl': # subcommand to control a running rotator
+        return ctl_main(argv[1:])
+    if argv and argv[0] == 'board': # subcommand to show the status board of all the rotators
+        return board_main(argv[1:])
 
     #==== COMMANDLINE PARSER ====
 
@@ -636,8 +3132,94 @@ def main(argv=None):
                         help='Password for remote download (will be passed as $_GET parameter).')
     slots_parser.add_argument('--outputlogrotator', metavar='/some/file.txt', type=str, nargs=1, required=False,
                         help='Redirect all outputs to a log file.')
+    slots_parser.add_argument('--status-board', metavar='/some/status.board', type=str, nargs=1, required=False,
+                        help='Publish the state of this rotator (slot, next deadline, lateness, health) in this status board, shared by all the rotators of the host. Show it with: oa-game-rotator.py board /some/status.board')
+    slots_parser.add_argument('--webhook-port', metavar='port', type=int, nargs=1, required=False,
+                        help='Listen on this port for the notifications of the booking manager (HTTP GET or POST with the server and date parameters), to download the slotsfile right away when the bookings change. The slotsfile is then polled only every --webhook-poll minutes, in case a notification is lost.')
+    slots_parser.add_argument('--webhook-address', metavar='address', type=str, nargs=1, required=False,
+                        help='Address to listen on for the notifications (default: 127.0.0.1, use 0.0.0.0 if the booking manager is on another host).')
+    slots_parser.add_argument('--webhook-token', metavar='secret', type=str, nargs=1, required=False,
+                        help='Only accept the notifications carrying this token (token parameter or X-Token header).')
+    slots_parser.add_argument('--webhook-poll', metavar='minutes', type=int, nargs=1, required=False,
+                        help='Minutes between two checks for a slotsfile when there is none, with --webhook-port (default: 60 instead of 5).')
+    slots_parser.add_argument('--control-socket', metavar='/some/rotator.sock', type=str, nargs=1, required=False,
+                        help='Serve a control socket at this path, to get the status of the rotator and to reload the slotsfile, apply the next transition now, or pause and resume the transitions. Use it with: oa-game-rotator.py ctl /some/rotator.sock status|reload|apply|pause|resume')
+    slots_parser.add_argument('--journal', metavar='/some/journal.jsonl', type=str, nargs=1, required=False,
+                        help='Append a record of each transition to this journal (use one per server). Query it with: oa-game-rotator.py journal /some/journal.jsonl --help')
+    slots_parser.add_argument('--profile-dir', metavar='/some/folder/', type=str, nargs=1, required=False,
+                        help='Folder where the profiling stats are saved (default: the current folder). Send SIGUSR1 to the rotator to start profiling, and again to stop and save the stats (readable with pstats). Send SIGUSR2 to take a memory snapshot and see the top allocations since the previous one.')
+    slots_parser.add_argument('--command-timeout', metavar='seconds', type=int, nargs=1, required=False,
+                        help='Kill the commands (oamps.sh) that are still running after this time, so that a hung command does not stop the rotator (default: 120, 0 to disable). They first get a SIGTERM, then a SIGKILL.')
+    slots_parser.add_argument('--command-kill-grace', metavar='seconds', type=int, nargs=1, required=False,
+                        help='Time between the SIGTERM and the SIGKILL of a command that timed out (default: 5).')
+    slots_parser.add_argument('--rotator-log-max-size', metavar='megabytes', type=int, nargs=1, required=False,
+                        help='Rotate the log of --outputlogrotator when it gets bigger than this size (default: 10). The rotated logs are compressed with gzip.')
+    slots_parser.add_argument('--rotator-log-max-age', metavar='hours', type=int, nargs=1, required=False,
+                        help='Rotate the log of --outputlogrotator after this time (default: 24, 0 to disable).')
+    slots_parser.add_argument('--rotator-log-keep', metavar='number', type=int, nargs=1, required=False,
+                        help='Number of rotated logs to keep (default: 10).')
     slots_parser.add_argument('--margin-delay', metavar='seconds', type=int, nargs=1, required=False,
                         help='Seconds to wait after the planned end time of a booking to switch to the next (this allows players to take the time to end the match). Note: not applied when there\'s no booking, the next booking will begin right on time. Default: 2 minutes.')
+    slots_parser.add_argument('--dayplan-file', metavar='/some/file.json', type=str, nargs=1, required=False,
+                        help='Save the plan of the day (all the transitions of the day with their precomputed commands and the errors found in the slotsfile) in a JSON file for inspection, each time it is compiled. The file is only readable by its owner, since the commands contain the passwords of the bookings.')
+    slots_parser.add_argument('--generated-cfg', action='store_true', required=False,
+                        help='Write the ingame commands of each slot in a generated config file and send only an exec command to the game server (avoids overflowing the Q3 command buffer). By default, the configs are generated in the homepath\'s base mod folder (eg: --homepath/baseoa/).')
+    slots_parser.add_argument('--generated-cfg-folder', metavar='/some/path/baseoa/', type=is_dir, nargs=1, required=False,
+                        help='Folder where to write the generated configs for the game server (must be in the game\'s search path). Implies --generated-cfg.')
+    slots_parser.add_argument('--generated-gtvcfg-folder', metavar='/some/path/', type=is_dir, nargs=1, required=False,
+                        help='Folder where to write the generated configs for the GTV server commands (must be in the GTV server\'s search path). If not set, the GTV commands are sent directly.')
+    slots_parser.add_argument('--rcon-gtv-password', metavar='somepassword', type=str, nargs=1, required=False,
+                        help='Rcon password of the GTV server: used to query the games the GTV server is connected to, so that only the needed gtv_disconnect and gtv_connect commands are sent (else the GTV server is blindly disconnected 12 times at each reconnection until the rotator knows its state).')
+    slots_parser.add_argument('--rcon-gtv-status', metavar='command', type=str, nargs=1, required=False,
+                        help='Console command of the GTV server that lists the games it is connected to (default: gtv_list).')
+    slots_parser.add_argument('--game-restart', action='store_true', required=False,
+                        help='Switch mods inside the running server with ioquake3\'s game_restart <mod> instead of a full restart of the server, when the binary, basepath and homepath don\'t change (else a hard restart is still done). Note: the config must load a map, as for a hard restart.')
+    slots_parser.add_argument('--standby-port', metavar='port', type=str, nargs=1, required=False,
+                        help='Enable hot standby for hard restarts (restart_hard slots): before the slot begins, the next slot\'s server is launched on this spare port, and at the slot boundary the GTV server is redirected to it and the old server is stopped. The two servers then swap their roles (ports and screen names) at each hard restart. Needs --port and --screenname.')
+    slots_parser.add_argument('--standby-screenname', metavar='somename', type=str, nargs=1, required=False,
+                        help='Screen name of the standby server (default: the screen name followed by -standby).')
+    slots_parser.add_argument('--standby-lead', metavar='seconds', type=int, nargs=1, required=False,
+                        help='Seconds before the slot boundary at which the standby server is launched (default: 120).')
+    slots_parser.add_argument('--server-timeout', metavar='seconds', type=int, nargs=1, required=False,
+                        help='Seconds to wait for a (re)started server to answer, to measure the downtime of the transitions (default: 60).')
+    slots_parser.add_argument('--supervise', action='store_true', required=False,
+                        help='Launch the game server as a child process of the rotator (instead of a screen session through oamps.sh), so that it is relaunched within seconds with the current slot\'s configuration if it crashes. The GTV server is still managed by oamps.sh.')
+    slots_parser.add_argument('--supervise-maxrestarts', metavar='number', type=int, nargs=1, required=False,
+                        help='Maximum number of relaunches of a crashing server in --supervise-window seconds, after which the supervisor gives up until the next slot (default: 5).')
+    slots_parser.add_argument('--supervise-window', metavar='seconds', type=int, nargs=1, required=False,
+                        help='Window for the relaunches rate limiting (default: 300).')
+    slots_parser.add_argument('--supervise-sample', metavar='seconds', type=int, nargs=1, required=False,
+                        help='Interval between two samples of the cpu and memory usage of the supervised servers (shown in verbose mode, default: 60).')
+    slots_parser.add_argument('--supervise-output', metavar='/some/file.txt', type=str, nargs=1, required=False,
+                        help='File where the output of the supervised servers is appended (default: discarded).')
+    slots_parser.add_argument('--health-interval', metavar='seconds', type=int, nargs=1, required=False,
+                        help='Check the game server every few seconds (one getstatus packet) and re-apply what differs from the current slot (password, map, mod) if it drifted, eg: after a manual restart. Disabled by default.')
+    slots_parser.add_argument('--health-failures', metavar='number', type=int, nargs=1, required=False,
+                        help='Number of health checks in a row without answer before the game server is relaunched (default: 3).')
+    slots_parser.add_argument('--player-aware', action='store_true', required=False,
+                        help='Instead of always waiting the margin delay after a booking, check the players at the slot boundary: transition right away if the server is empty, or wait for the end of the match (up to --match-wait-cap seconds).')
+    slots_parser.add_argument('--match-wait-cap', metavar='seconds', type=int, nargs=1, required=False,
+                        help='Maximum time to wait for the end of a match after the slot boundary with --player-aware (default: 900).')
+    slots_parser.add_argument('--game-log', metavar='/some/path/games.log', type=str, nargs=1, required=False,
+                        help='Follow the game server\'s log (g_log) to detect the match ends: with --player-aware, the transition then happens on the first match end after the slot boundary.')
+    slots_parser.add_argument('--margin-history', metavar='/some/file.json', type=str, nargs=1, required=False,
+                        help='Record the match ends after the slots boundaries per mod and gametype in this file, and use the margin delay that lets --margin-percentile of the matches finish (up to --margin-max), once there are enough samples.')
+    slots_parser.add_argument('--margin-percentile', metavar='percent', type=int, nargs=1, required=False,
+                        help='Percentile of the matches the learned margin delay must let finish (default: 90).')
+    slots_parser.add_argument('--margin-max', metavar='seconds', type=int, nargs=1, required=False,
+                        help='Maximum learned margin delay (default: 600).')
+    slots_parser.add_argument('--margin-decay', metavar='factor', type=float, nargs=1, required=False,
+                        help='Weight kept by the past samples of the --margin-history at each new match end of the same mod and gametype, so that the learned margin delay follows the recent matches (default: 0.95, about the last 20 matches).')
+    slots_parser.add_argument('--warning-offsets', metavar='300,60,30,10', type=str, nargs=1, required=False,
+                        help='Offsets (in seconds before the transition) at which the players are warned during a --countdown (default: 300,120,60,30,10,5,4,3,2,1). The offsets under 10 seconds need --rconpassword or --supervise.')
+    slots_parser.add_argument('--rconpassword', metavar='somepassword', type=str, nargs=1, required=False,
+                        help='Rcon password of the game server, to send the countdown warnings by rcon instead of through oamps.sh.')
+    slots_parser.add_argument('--timings-file', metavar='/some/file.jsonl', type=str, nargs=1, required=False,
+                        help='Append the timings of each transition (one JSON record per line) to this file. The records are always printed, and the rolling percentiles too in verbose mode.')
+    slots_parser.add_argument('--metrics-file', metavar='/some/path/oa-game-rotator.prom', type=str, nargs=1, required=False,
+                        help='Write the metrics of the rotator in the Prometheus text format in this file (eg: in the folder of the textfile collector of node_exporter), every 10 seconds if they changed.')
+    slots_parser.add_argument('--metrics-port', metavar='port', type=int, nargs=1, required=False,
+                        help='Serve the metrics of the rotator in the Prometheus text format on http://127.0.0.1:port/')
     slots_parser.add_argument('-op', '--oampsfullpath', metavar='/some/path/oamps.sh', type=str, nargs=1, required=False,
                         help='Fullpath to oamps.sh script, including the script filename (default: same folder as the oa-game-rotator.py)')
     # OAMPS arguments
@@ -647,9 +3229,9 @@ def main(argv=None):
     oamps_parser.add_argument('-bin', '--binfullpath', metavar='/some/path', type=str, nargs=1, required=False,
                         help='see oamps help')
     oamps_parser.add_argument('--countdown', type=str, nargs=1, required=False,
-                        help='see oamps help')
+                        help='Seconds of countdown before a transition that restarts the server (the players are warned at --warning-offsets, this is done by the rotator, not by oamps)')
     oamps_parser.add_argument('--countdownmessage', type=str, nargs=1, required=False,
-                        help='see oamps help')
+                        help='Message of the countdown warnings, followed by the remaining time (default: "The next booking begins in")')
     oamps_parser.add_argument('-e', '--exec', type=str, nargs=1, required=False,
                         help='see oamps help')
     oamps_parser.add_argument('-ec', '--execconfig', type=str, nargs=1, required=False,
@@ -663,11 +3245,11 @@ def main(argv=None):
     oamps_parser.add_argument('--homepath', type=str, nargs=1, required=False,
                         help='see oamps help')
     oamps_parser.add_argument('--heartbeat', action='store_true', required=False,
-                        help='see oamps help')
+                        help='see oamps help (if --rcon-gtv-password is set, the heartbeats are sent by the rotator instead of a separate heartbeater process: the GTV server must then accept the heartbeat command by rcon)')
     oamps_parser.add_argument('--heartbeatscreen', type=str, nargs=1, required=False,
                         help='see oamps help')
     oamps_parser.add_argument('--heartbeattime', type=str, nargs=1, required=False,
-                        help='see oamps help')
+                        help='see oamps help (interval in seconds between two heartbeats sent by the rotator, default: 300)')
     oamps_parser.add_argument('-k', '--killall', action='store_true', required=False,
                         help='see oamps help')
     oamps_parser.add_argument('-k2', '--killall2', action='store_true', required=False,
@@ -732,6 +3314,12 @@ def main(argv=None):
 
     #== Global variables
     startup = True # is used to force restart of the server at startup (by appending --restart and avoid the countdown), then the next iterations will do as the slotsfile require
+    idleapplied = False # is the default config already applied while there's no slotsfile (idle mode)? Then we don't resend it until a slotsfile appears
+    idlecommandscount = 0 # number of commands sent when the default config was applied
+    suppressedcommands = 0 # total number of commands that were not sent to the server in idle mode because nothing changed
+    livehealth = None # health entry of the slot running on the game server (see make_health_entry), to send it ingame commands such as the countdown warnings
+    lastapplied = None # slot, booking and desired state of the last transition, so that a reload does not apply the current slot again if it did not change
+    reloaded = False # is the plan recompiled in the middle of a slot (see take_action)?
 
     #== Parsing the arguments
     [args, rest] = slots_parser.parse_known_args(argv) # Storing all arguments to args
@@ -747,20 +3335,39 @@ def main(argv=None):
     if args.margin_delay: # Override the margin delay if specified at commandline
         margindelay = args.margin_delay[0]
 
-    if oampsargs.has_key('countdown') and oampsargs['countdown'] and oampsargs['countdown'] != False:
-        countdown = int(oampsargs['countdown'][0])
-        margindelay = margindelay - countdown # adjusting margindelay with the countdown (we must launch the commands earlier because the countdown will delay a lot the effective beginning of the next booking)
-    else:
-        countdown = None
+    # Countdown: the players are warned by the rotator before the transitions (see countdownwait), which happen at the exact deadline
+    countdownoffsets = [300, 120, 60, 30, 10, 5, 4, 3, 2, 1]
+    if args.warning_offsets:
+        countdownoffsets = [int(offset) for offset in args.warning_offsets[0].split(',') if offset.strip()]
+    rconpassword = None
+    if args.rconpassword:
+        rconpassword = args.rconpassword[0]
+    # without rcon nor the supervisor, each warning is sent by a run of oamps.sh, which takes too long for the warnings of the last seconds (they would pile up and delay the transition)
+    if not rconpassword and not args.supervise and [offset for offset in countdownoffsets if offset < 10]:
+        countdownoffsets = [offset for offset in countdownoffsets if offset >= 10]
+        if args.warning_offsets:
+            print('The countdown warnings under 10 seconds need --rconpassword or --supervise, they are disabled.')
 
     if oampsargs.has_key('addcron'): # Security to avoid addcron which may corrupts the cron job file
         del oampsargs['addcron']
     if oampsargs.has_key('a'):
         del oampsargs['a']
 
-    if args.outputlogrotator:
-        sys.stdout = Tee(args.outputlogrotator[0], 'a')
-        sys.stderr = Tee(args.outputlogrotator[0], 'a')
+    if args.command_timeout:
+        command_timeout = args.command_timeout[0]
+    if args.command_kill_grace:
+        command_kill_grace = args.command_kill_grace[0]
+    # When the rotator is stopped (SIGTERM), exit normally so that the atexit handlers are run (eg: write the last lines of the log, stop the supervised servers)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    if args.outputlogrotator: # log file of the rotator (one shared buffered writer for stdout and stderr, and the output of the commands)
+        logwriter = LogWriter(fullpath(args.outputlogrotator[0]),
+                              (args.rotator_log_max_size[0] if args.rotator_log_max_size else 10)*1024*1024,
+                              (args.rotator_log_max_age[0] if args.rotator_log_max_age else 24)*3600,
+                              args.rotator_log_keep[0] if args.rotator_log_keep else 10)
+        sys.stdout = LogStream(logwriter, 'stdout', sys.stdout)
+        sys.stderr = LogStream(logwriter, 'stderr', sys.stderr)
+        import atexit
+        atexit.register(logwriter.close) # write the last lines at exit
 
     if args.default_gamemod: # default mod if the slot is not booked or no slotsfile found for today
         defaultmod = args.default_gamemod[0] # if specified at commandline, we set the default gamemod to the one specified
@@ -771,6 +3378,151 @@ def main(argv=None):
     if args.oampsfullpath: # since we get the params and values from argparse, it has the bad habit of always creating a list for values even if it's a single value, so here if that's the case, we fetch the single value inside the list
         oampsfullpath = args.oampsfullpath[0]
 
+    cfgfolder = None # folder where to write the generated configs (None to send the ingame commands directly)
+    if args.generated_cfg_folder:
+        cfgfolder = fullpath(args.generated_cfg_folder[0])
+    elif args.generated_cfg:
+        if oampsargs['homepath']:
+            homepath = oampsargs['homepath'][0]
+        else:
+            homepath = '~/.openarena' # ioquake3's default homepath for OpenArena
+        if oampsargs['gamebasemod']:
+            basemod = oampsargs['gamebasemod'][0]
+        else:
+            basemod = 'baseoa'
+        cfgfolder = fullpath(os.path.join(homepath, basemod))
+        if not os.path.isdir(cfgfolder):
+            print('ERROR: '+cfgfolder+' is not a directory, the generated configs can\'t be written there, please set --generated-cfg-folder. The ingame commands will be sent directly.')
+            cfgfolder = None
+    gtvcfgfolder = None
+    if args.generated_gtvcfg_folder:
+        gtvcfgfolder = fullpath(args.generated_gtvcfg_folder[0])
+
+    load_slot_handlers_plugins() # third-party handlers for slot parameters
+
+    standbytimeout = 60 # seconds to wait for a server to answer after a (re)start
+    if args.server_timeout:
+        standbytimeout = args.server_timeout[0]
+    standby = None # hot standby for hard restarts (the two servers swap their ports and screen names at each hard restart)
+    if args.standby_port:
+        if not oampsargs['port'] or not oampsargs['screenname']:
+            print('ERROR: --standby-port needs --port and --screenname to be set, hot standby is disabled.')
+        else:
+            if args.standby_screenname:
+                standbyscreenname = args.standby_screenname[0]
+            else:
+                standbyscreenname = oampsargs['screenname'][0] + '-standby'
+            standby = {'ports': [oampsargs['port'][0], args.standby_port[0]],
+                       'screennames': [oampsargs['screenname'][0], standbyscreenname],
+                       'active': 0, # index of the server currently active
+                       'lead': 120}
+            if args.standby_lead:
+                standby['lead'] = args.standby_lead[0]
+
+    eventloop = EventLoop() # runs the background tasks while waiting for the next slot
+    Profiler(eventloop, fullpath(args.profile_dir[0]) if args.profile_dir else os.getcwd()) # SIGUSR1: cProfile, SIGUSR2: memory snapshot
+    control = None # control socket (status, reload, apply, pause, resume)
+    if args.control_socket:
+        try:
+            control = ControlServer(eventloop, fullpath(args.control_socket[0]))
+            import atexit
+            atexit.register(control.close)
+            control.status['server'] = servername
+        except (IOError, OSError) as inst: # socket.error is an IOError
+            print('ERROR: the control socket could not be created at '+args.control_socket[0]+'. Error: '+str(inst))
+    if args.webhook_port: # notifications of the booking manager
+        try:
+            WebhookServer(eventloop, servername, args.webhook_port[0], args.webhook_address[0] if args.webhook_address else '127.0.0.1', args.webhook_token[0] if args.webhook_token else None)
+            defaultwait = args.webhook_poll[0] if args.webhook_poll else 60 # the changes are pushed, polling is only a fallback
+        except (IOError, OSError) as inst:
+            print('ERROR: the webhook receiver could not listen on port '+str(args.webhook_port[0])+', the slotsfile will be polled as usual. Error: '+str(inst))
+    supervisor = None # native supervisor of the game server
+    if args.supervise:
+        supervisor = Supervisor(eventloop,
+                                args.supervise_maxrestarts[0] if args.supervise_maxrestarts else 5,
+                                args.supervise_window[0] if args.supervise_window else 300,
+                                sampleinterval=args.supervise_sample[0] if args.supervise_sample else 60,
+                                outputfile=fullpath(args.supervise_output[0]) if args.supervise_output else None,
+                                verbose=oampsargs['verbose'])
+        if standby is not None:
+            print('ERROR: hot standby is not supported with --supervise, it is disabled.')
+            standby = None
+        # stop the supervised servers when the rotator is stopped
+        import atexit
+        atexit.register(supervisor.stopall)
+
+    matchwaitcap = 900 # maximum seconds to wait for the end of a match with --player-aware
+    if args.match_wait_cap:
+        matchwaitcap = args.match_wait_cap[0]
+
+    gamelog = None # state of the game server parsed from its log
+    if args.game_log:
+        gamelog = GameLog()
+        def wakeup_on_match_end(event, argument): # wake up the waits on a match end
+            if event in ['exit', 'shutdown']:
+                eventloop.stop()
+        gamelog.listeners.append(wakeup_on_match_end)
+        if oampsargs['verbose']:
+            gamelog.listeners.append(lambda event, argument: sys.stdout.write('Game log event: '+event+' '+argument+'\n'))
+        LogTail(eventloop, fullpath(args.game_log[0]), gamelog.feed)
+
+    timings = TransitionTimings(fullpath(args.timings_file[0]) if args.timings_file else None) # timings of the phases of the transitions
+    journal = None # durable record of the transitions
+    if args.journal:
+        journal = Journal(fullpath(args.journal[0]))
+
+    if args.metrics_file or args.metrics_port:
+        MetricsExporter(eventloop, metrics, fullpath(args.metrics_file[0]) if args.metrics_file else None, args.metrics_port[0] if args.metrics_port else None)
+
+    history = None # history of the match ends, to learn the margin delay
+    if args.margin_history:
+        history = MatchHistory(fullpath(args.margin_history[0]),
+                               args.margin_max[0] if args.margin_max else 600,
+                               percentile=args.margin_percentile[0] if args.margin_percentile else 90,
+                               decay=args.margin_decay[0] if args.margin_decay else 0.95)
+
+    healthcheck = None # periodic check of the game server's state
+    if args.health_interval:
+        healthcheck = HealthCheck(eventloop, args.health_interval[0], supervisor=supervisor,
+                                  maxfailures=args.health_failures[0] if args.health_failures else 3,
+                                  grace=standbytimeout, verbose=oampsargs['verbose'], rconpassword=rconpassword)
+
+    board = None # status board shared with the other rotators of the host
+    boardidle = False # state published in the status board, besides the record of the last transition
+    lastexits = []
+    if args.status_board:
+        try:
+            board = StatusBoard(fullpath(args.status_board[0]), servername)
+            eventloop.add_timer(5, lambda: publish_board(board, boardidle, lastexits, control, healthcheck, supervisor), delay=0) # refresh the health flags (and the time of the last update, which tells the rotator is alive)
+            import atexit
+            atexit.register(lambda: board.update(flags=['stopped']))
+        except (IOError, OSError) as inst:
+            print('ERROR: the status board '+args.status_board[0]+' could not be used. Error: '+str(inst))
+
+    global gtv_rcon
+    if args.rcon_gtv_password and oampsargs['gtvport']: # query the GTV server's connections by rcon
+        if args.rcon_gtv_status:
+            gtvstatuscommand = args.rcon_gtv_status[0]
+        else:
+            gtvstatuscommand = 'gtv_list'
+        gtv_rcon = ('localhost', oampsargs['gtvport'][0], args.rcon_gtv_password[0], gtvstatuscommand)
+
+    # Heartbeats: sent by the rotator if it can reach the GTV server by rcon, the heartbeater of oamps.sh is then not started
+    if oampsargs['heartbeat'] and gtv_rcon is not None:
+        heartbeatinterval = 300
+        if oampsargs['heartbeattime']:
+            heartbeatinterval = int(oampsargs['heartbeattime'][0])
+        heartbeater = Heartbeater(eventloop, heartbeatinterval, verbose=oampsargs['verbose'])
+        heartbeater.add_server(gtv_rcon[0], gtv_rcon[1], gtv_rcon[2])
+        if rconpassword: # the game server(s) too, so that they are listed again right after a restart
+            for port in (standby['ports'] if standby is not None else ([oampsargs['port'][0]] if oampsargs['port'] else [])):
+                heartbeater.add_server('localhost', port, rconpassword)
+        oampsargs['heartbeat'] = False
+        oampsargs['heartbeatscreen'] = None
+        oampsargs['heartbeattime'] = None
+    elif oampsargs['heartbeat']:
+        print('Heartbeats are sent by the heartbeater of oamps.sh, set --rcon-gtv-password to send them from the rotator instead.')
+
     #===== MAIN LOOP ====
     # loop indefinitely
     while 1:
@@ -781,61 +3533,150 @@ def main(argv=None):
         todayslotsfilepath = get_slotsfilename(today, slotsfolder, servername) # get today's slotsfile path
 
         #== Downloading slots file (if remote adress and password was specified in arguments)
+        cyclephases = dict() # durations of the phases of this cycle, recorded with the first transition (see TransitionTimings)
         if (args.download_url and args.download_password):
+            start = time.time()
             download_slotsfile(slotsfolder, servername, today, args.download_url[0], args.download_password[0])
+            cyclephases['download'] = time.time() - start
 
         #== Read slots and nbslots from slots file
+        start = time.time()
         r = read_slotsfile(slotsfolder, servername, delimiter, assign)
+        cyclephases['read_slotsfile'] = time.time() - start
 
         #-- Loading default config if there's no slots file
         if r is None:
-            print('No slots file could be found for today, the month, the year or even just the server. Loading the default config.')
-            commands = make_oamps_command(defaultconf, defaultmod, oampsargs, None, startup, oampsfullpath)
-            startup = False # set to false so that we don't restart automatically the next servers (unless required by the slotsfile)
-            #-- Execute the commands
-            for command in commands:
-                if command is not None:
-                    if oampsargs['verbose']:
-                        print(command)
-                    os.system(command)
+            # Idle mode: the default config is applied only once, then we only watch for a slotsfile to appear (nothing is sent to the server until something changes)
+            if not idleapplied:
+                print('No slots file could be found for today, the month, the year or even just the server. Loading the default config.')
+                info = dict()
+                start = time.time()
+                commands = make_oamps_command(defaultconf, defaultmod, get_active_oampsargs(oampsargs, standby), None, startup, oampsfullpath, cfgfolder, gtvcfgfolder, info)
+                entry = {'slot': None, 'kind': 'idle', 'timings': {'compile': time.time() - start}}
+                startup = False # set to false so that we don't restart automatically the next servers (unless required by the slotsfile)
+                #-- Execute the commands
+                if healthcheck is not None:
+                    healthcheck.join()
+                start = time.time()
+                if supervisor is not None:
+                    apply_supervise_entry(make_supervise_entry(info), supervisor)
+                    commands = commands[info['nbgamecommands']:]
+                entry['health'] = make_health_entry(info)
+                entry['exitcodes'] = []
+                entry['timings']['commandsdurations'] = execute_commands(commands, oampsargs['verbose'], make_entry_tags(entry), entry['exitcodes'])
+                entry['timings']['commands'] = sum(entry['timings']['commandsdurations'])
+                record = timings.record(entry, start, cyclephases)
+                if journal is not None:
+                    journal.record(record, entry, servername)
+                if logwriter is not None:
+                    logwriter.flush()
+                livehealth = entry['health'] # the slot running on the game server (to send it the countdowns)
+                if healthcheck is not None:
+                    healthcheck.set_slot(livehealth)
+                if control is not None:
+                    record['exits'] = entry['exitcodes']
+                    control.status.update({'slot': None, 'kind': 'idle', 'params': make_control_params(livehealth), 'last': record, 'next': None})
+                boardidle = True
+                lastexits = entry['exitcodes']
+                if board is not None:
+                    publish_board(board, boardidle, lastexits, control, healthcheck, supervisor, slot=-1, kind='idle', deadline=0.0, lateness=0.0)
+                idleapplied = True
+                idlecommandscount = len([command for command in commands if command]) # remember how many commands we would send at each check, to count the suppressed ones
+            else:
+                suppressedcommands += idlecommandscount
+                print('No slots file found, the default config is already applied: nothing changed, '+str(idlecommandscount)+' commands suppressed ('+str(suppressedcommands)+' in total).')
 
             print('Waiting ' + str(defaultwait) + ' minutes before checking again if a slotfile exists.')
-            if countdown: # If there's a countdown, we must launch commands earlier in case the next slot is booked, so that we don't begin the next booking too late
-                slotwait(int(24*60/int(defaultwait)), timedelimiter, -countdown) # we wait using the slotwait function so that we synchronize with the time (if we use time.sleep(), we may miss the beginning of a slot, when with slotwait we have much less chances)
-            else: # Else no countdown, we just launch the commands right on time
-                slotwait(int(24*60/int(defaultwait)), timedelimiter)
+            idlewait(int(24*60/int(defaultwait)), slotsfolder, servername, timedelimiter, eventloop=eventloop) # we wait using the idlewait function so that we synchronize with the time (if we use time.sleep(), we may miss the beginning of a slot, when with idlewait we have much less chances)
+            take_action(eventloop, control) # any action (or the end of a pause) only means checking the slotsfiles now in idle mode
         #-- Loading the slots list if a slots file is found
         else:
+            idleapplied = False # a schedule was found, so the default config will have to be applied again if we go back to idle mode
             [nbslots, slots] = r # assigning total number of slots and slots list
 
             #lastslot = -1 # memorize the last slot, so that we don't issue twice the same commands to the server (and so that we know when we must redownload the new slotsfile if we change day)
 
             #== SECOND MAIN LOOP ==
 
-            # loop until nextslot belongs to the next day (when nextslot = 0)
-            [currslot, nextslot, nexttime, nexttimestr, sleeptime] = get_slots_time_infos(nbslots, timedelimiter, margindelay)
-
-            # While we are today (we loop until the very last slot, the next slot being 0 since it belongs to the next day slotsfile)
-            while 1:
-                #-- Get slots infos
-                [currslot, nextslot, nexttime, nexttimestr, sleeptime] = get_slots_time_infos(nbslots, timedelimiter, margindelay)
-
-                #-- Get the commands for the current slot
-                commands = make_oamps_command(defaultconf, defaultmod, oampsargs, slots[currslot], startup, oampsfullpath)
-                startup = False # set to false so that we don't restart automatically the next servers (unless required by the slotsfile)
-
-                #-- Execute the commands
-                for command in commands:
-                    if command is not None:
-                        if oampsargs['verbose']:
-                            print(command)
-                        os.system(command)
-
-                #-- Wait for the next slot
-                slotwait(nbslots, timedelimiter, margindelay)
-
-                #-- Break loop if we day changed (we loop until the very last slot, the next slot being 0 since it belongs to the next day slotsfile)
-                if currslot > nextslot: break # quick fix: if we launch the game rotator at the last slot of the day (eg: between 23:30 and 00:00 if there are 48 slots), we get an infinite loop of downloading the slots file until the next slot. Here we force to do the while and check only here at the end of the block to break and to download the new day's slotsfile.
+            #-- Compile the plan of the day (all the commands for all the remaining slots of the day are built right now, so that errors are reported immediately)
+            start = time.time()
+            plan = compile_dayplan(nbslots, slots, defaultconf, defaultmod, oampsargs, startup, oampsfullpath, timedelimiter, margindelay, cfgfolder, gtvcfgfolder, standby, args.game_restart and not args.supervise, args.supervise)
+            cyclephases['compile_dayplan'] = time.time() - start
+            for folder in set([cfgfolder, gtvcfgfolder]):
+                if folder:
+                    remove_generated_cfgs(folder)
+            generated_cfgs.clear()
+            startup = False # set to false so that we don't restart automatically the next servers (unless required by the slotsfile)
+            if args.dayplan_file: # save the plan of the day for inspection (only the owner can read it, since the commands contain the passwords of the bookings)
+                fd = os.open(args.dayplan_file[0], os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+                os.fchmod(fd, 0o600) # also if the file was already there
+                f = os.fdopen(fd, 'w')
+                f.write(dayplan_to_json(plan))
+                f.close()
+
+            # Loop through the entries of the plan until the end of the day (the last entry has no command and its deadline is the first slot of the next day, so that we then load the next day's slotsfile)
+            for entry in plan['entries']:
+                if entry['deadline'] is not None:
+                    metrics.set('oagamerotator_next_deadline_timestamp_seconds', utc_to_timestamp(entry['deadline']))
+                if board is not None and entry['deadline'] is not None:
+                    board.update(deadline=utc_to_timestamp(entry['deadline']))
+                if control is not None:
+                    control.status['next'] = {'slot': entry['slot'], 'kind': entry['kind'], 'deadline': entry['deadline'].strftime("%Y-%m-%d %H:%M:%S") if entry['deadline'] is not None else None}
+                #-- Wait for the entry's deadline (None means right now)
+                sendcountdown = lambda commands, health=livehealth: send_ingame_commands(commands, health, supervisor, rconpassword, oampsargs['verbose'])
+                applied = [entry['slot'], entry.get('booking'), entry['health']['desired'] if entry.get('health') else None]
+                if entry['deadline'] is not None and (args.player_aware or history is not None) and entry.get('liveport'):
+                    changed = lastapplied is None or applied[1:] != lastapplied[1:] # does the booking change at this boundary?
+                    reason = playerwait(entry, margindelay, matchwaitcap, eventloop, gamelog, history, args.player_aware, changed)
+                    if entry.get('countdown') and reason not in ['empty server', 'players left', 'interrupted']: # the transition is decided now, the players still get their countdown
+                        countdownwait(datetime.datetime.utcnow() + datetime.timedelta(seconds=entry['countdown']), entry['countdown'], entry['countdownmessage'], countdownoffsets, sendcountdown, eventloop)
+                elif entry['deadline'] is not None and entry.get('countdown'):
+                    planwait(entry['deadline'] - datetime.timedelta(seconds=entry['countdown']), eventloop)
+                    countdownwait(entry['deadline'], entry['countdown'], entry['countdownmessage'], countdownoffsets, sendcountdown, eventloop)
+                elif entry['deadline'] is not None:
+                    planwait(entry['deadline'], eventloop)
+                action = take_action(eventloop, control) # the wait may have been interrupted by the control socket or the webhook (or the transitions paused)
+                if action == 'reload': # back to the main loop, to download and read the slotsfile and compile the plan from the current slot
+                    print('Reloading the slotsfile now.')
+                    reloaded = True
+                    break
+                elif action == 'apply':
+                    print('Applying the next transition now instead of waiting for its deadline.')
+                if reloaded and entry['deadline'] is None and applied == lastapplied: # the current slot did not change, don't disturb the players
+                    print('Slot '+str(entry['slot'])+' did not change, it is not applied again.')
+                    set_command_state(entry['state'])
+                    reloaded = False
+                    continue
+                reloaded = False
+                if entry['kind'] not in ['end', 'prewarm']: # after a prewarm, the players are still on the previous slot
+                    lastapplied = applied
+
+                #-- Execute the precomputed commands
+                if healthcheck is not None:
+                    healthcheck.join()
+                start = time.time()
+                execute_plan_entry(entry, oampsargs['verbose'], standbytimeout, supervisor, standby)
+                if entry['kind'] != 'end':
+                    record = timings.record(entry, start, cyclephases)
+                    if journal is not None:
+                        journal.record(record, entry, servername)
+                    cyclephases = dict()
+                    if oampsargs['verbose']:
+                        print(timings.summary())
+                if logwriter is not None: # the log of a transition is written right away
+                    logwriter.flush()
+                if entry.get('health'):
+                    livehealth = entry['health']
+                    if healthcheck is not None:
+                        healthcheck.set_slot(livehealth)
+                if control is not None and entry['kind'] != 'end':
+                    record['exits'] = entry.get('exitcodes', [])
+                    control.status.update({'slot': entry['slot'], 'kind': entry['kind'], 'params': make_control_params(livehealth), 'last': record})
+                if entry['kind'] != 'end':
+                    boardidle = False
+                    lastexits = entry.get('exitcodes', [])
+                    if board is not None:
+                        publish_board(board, boardidle, lastexits, control, healthcheck, supervisor, slot=entry['slot'] if entry['slot'] is not None else -1, kind=entry['kind'], lateness=record['phases'].get('lateness', 0.0))
 
 
 # Calling main function if the script is directly called (not imported as a library in another program)
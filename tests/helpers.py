@@ -0,0 +1,11 @@
+# Helpers for the tests: the rotator is a script (oa-game-rotator.py), not a package, so it is loaded from its path
+import os, sys, unittest
+
+rotatorpath = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'oa-game-rotator.py')
+
+# Load the rotator as a module (the tests are skipped on Python 3, since the rotator is a Python 2.7 program)
+def load_rotator():
+    if sys.version_info[0] > 2:
+        raise unittest.SkipTest('the rotator runs on Python 2.7')
+    import imp
+    return imp.load_source('oagamerotator', rotatorpath)
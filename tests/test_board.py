@@ -0,0 +1,62 @@
+# Tests of the status board (StatusBoard and read_status_board)
+import mmap, os, shutil, struct, tempfile, time, unittest
+import helpers
+
+rotator = None
+
+def setUpModule():
+    global rotator
+    rotator = helpers.load_rotator()
+
+class StatusBoardTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, 'status.board')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    # A writer process updates its record as fast as it can, with the same value in two fields: the reader never gets a torn record
+    def test_concurrent_reads_are_consistent(self):
+        board = rotator.StatusBoard(self.path, 'srv')
+        pid = os.fork()
+        if pid == 0: # writer
+            try:
+                end = time.time() + 1
+                i = 0
+                while time.time() < end:
+                    i += 1
+                    board.update(slot=i, lateness=float(i))
+            finally:
+                os._exit(0)
+        nbreads = 0
+        try:
+            while nbreads == 0 or os.waitpid(pid, os.WNOHANG) == (0, 0):
+                for record in rotator.read_status_board(self.path):
+                    self.assertNotIn('inconsistent', record['flags'])
+                    if record['slot'] is not None:
+                        self.assertEqual(float(record['slot']), record['lateness'])
+                nbreads += 1
+        finally:
+            try:
+                os.waitpid(pid, 0)
+            except OSError: # already reaped by the loop
+                pass
+        self.assertTrue(nbreads > 1)
+
+    # A record left in the middle of an update (odd sequence number, eg: its rotator was killed) is flagged after the retries
+    def test_torn_record_is_flagged(self):
+        board = rotator.StatusBoard(self.path, 'srv')
+        board.update(slot=3, kind='slot')
+        self.assertEqual(rotator.read_status_board(self.path)[0]['flags'], [])
+        f = open(self.path, 'r+b')
+        mapping = mmap.mmap(f.fileno(), 0)
+        struct.pack_into('<I', mapping, board.offset, 7)
+        mapping.close()
+        f.close()
+        record = rotator.read_status_board(self.path, retries=3)[0]
+        self.assertEqual(record['name'], 'srv')
+        self.assertIn('inconsistent', record['flags'])
+
+if __name__ == '__main__':
+    unittest.main()
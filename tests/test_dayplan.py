@@ -0,0 +1,30 @@
+# Tests of the compilation of the plan of the day (compile_dayplan)
+import unittest
+import helpers
+
+rotator = None
+
+def setUpModule():
+    global rotator
+    rotator = helpers.load_rotator()
+
+class InvalidSlotTest(unittest.TestCase):
+    def setUp(self):
+        rotator.set_command_state({'binfullpath': '', 'gtvfullpath': '', 'gamemod': 'baseoa', 'serverpaths': None, 'desired': {'password': None, 'map': None, 'gamemod': 'baseoa'}})
+
+    # A bad booking falls back to the default config, and must not leave anything of itself in the plan nor in the running state (eg: its mod)
+    def test_invalid_slot_leaves_no_trace(self):
+        slots = [{'gamemod': 'cpma', 'restart_hard': '', 'countdown': 'abc'}] # one slot for the whole day, so it's the current one
+        plan = rotator.compile_dayplan(1, slots, 'def.cfg', None, {'port': ['27960'], 'screenname': ['srv']}, oampsfullpath='/bin/true')
+        entry = plan['entries'][0]
+        self.assertEqual(entry['slot'], 0)
+        self.assertEqual(len(entry['errors']), 1)
+        self.assertTrue(entry['errors'][0].startswith('invalid slot 0'))
+        self.assertEqual(entry['booking'], None)
+        self.assertEqual(entry['state']['gamemod'], 'baseoa')
+        self.assertEqual(entry['health']['desired']['gamemod'], 'baseoa')
+        self.assertFalse([command for command in entry['commands'] if 'cpma' in str(command)])
+        self.assertEqual(rotator.get_command_state()['gamemod'], 'baseoa')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,26 @@
+# Tests of the generated configs (make_exec_string)
+import os, shutil, stat, tempfile, unittest
+import helpers
+
+rotator = None
+
+def setUpModule():
+    global rotator
+    rotator = helpers.load_rotator()
+
+class GeneratedCfgTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    # The configs contain the passwords of the bookings: only their owner can read them
+    def test_cfg_is_private(self):
+        execstring = rotator.make_exec_string(['seta g_password "secret"', 'map_restart'], self.folder)
+        cfgpath = os.path.join(self.folder, execstring[len('exec '):])
+        self.assertEqual(stat.S_IMODE(os.stat(cfgpath).st_mode), 0o600)
+        self.assertEqual(open(cfgpath).read(), 'seta g_password "secret"\nmap_restart\n')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+# Tests of the GTV commands: precompiled in the plan, and only made again during a transition if the GTV server is not in the expected state (see resolve_gtv_command)
+import unittest
+import helpers
+
+rotator = None
+
+def setUpModule():
+    global rotator
+    rotator = helpers.load_rotator()
+
+class ResolveGtvCommandTest(unittest.TestCase):
+    def setUp(self):
+        self.queries = []
+        self.answer = None
+        self.query_gtv_connections = rotator.query_gtv_connections
+        rotator.query_gtv_connections = self.query
+        rotator.gtv_rcon = ('localhost', '31000', 'rconpass', 'gtv_list')
+        rotator.set_gtv_state([['localhost:27960'], ('localhost:27960', 'old')])
+
+    def tearDown(self):
+        rotator.query_gtv_connections = self.query_gtv_connections
+        rotator.gtv_rcon = None
+        rotator.forget_gtv_connections()
+
+    def query(self, host, port, password, command = 'gtv_list', timeout = 1.0):
+        self.queries.append(timeout)
+        return self.answer
+
+    # Build the GTV command of a slot reconnecting the GTV server with a new password
+    def make_gtv_command(self):
+        commands = rotator.make_oamps_command('def.cfg', None, {'port': ['27960'], 'gtvconfig': ['gtv.cfg']}, {'gtv': 'yes', 'password': 'new', 'restart_soft': ''}, oampsfullpath='/bin/true')
+        return commands[-1]
+
+    def test_precompiled_commands_are_used(self):
+        gtvcommand = self.make_gtv_command()
+        self.assertTrue('gtv_connect localhost:27960 "new"' in gtvcommand['commands'][0])
+        rotator.set_gtv_state(gtvcommand['assumed']) # as after the compilation of the plan
+        self.queries = []
+        self.assertEqual(rotator.resolve_gtv_command(gtvcommand), gtvcommand['commands'])
+        self.assertEqual(self.queries, [])
+        self.assertEqual(rotator.get_gtv_state(), gtvcommand['result'])
+
+    def test_commands_are_made_again_for_the_real_state(self):
+        gtvcommand = self.make_gtv_command()
+        rotator.set_gtv_state([['localhost:27960'], ('localhost:27960', 'new')]) # already connected with the new password
+        self.queries = []
+        self.assertEqual(rotator.resolve_gtv_command(gtvcommand), [gtvcommand['gtvcommand']]) # nothing to send to the GTV server
+        self.assertEqual(self.queries, [])
+
+    def test_unknown_state_is_queried_with_a_short_timeout(self):
+        gtvcommand = self.make_gtv_command()
+        rotator.forget_gtv_connections()
+        self.answer = None # the GTV server does not answer in time
+        self.queries = []
+        self.assertEqual(rotator.resolve_gtv_command(gtvcommand), gtvcommand['commands'])
+        self.assertEqual(self.queries, [rotator.gtv_query_timeout])
+        self.assertEqual(rotator.get_gtv_state(), gtvcommand['result'])
+
+if __name__ == '__main__':
+    unittest.main()
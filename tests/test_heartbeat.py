@@ -0,0 +1,48 @@
+# Tests of the heartbeats sent by the rotator (Heartbeater), with a fake GTV server listening on a local UDP port
+import socket, time, unittest
+import helpers
+
+rotator = None
+
+def setUpModule():
+    global rotator
+    rotator = helpers.load_rotator()
+
+class HeartbeaterTest(unittest.TestCase):
+    def setUp(self):
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.server.bind(('127.0.0.1', 0)) # free port
+        self.server.setblocking(0)
+        self.packets = []
+        self.eventloop = rotator.EventLoop()
+        self.eventloop.add_reader(self.server, self.answer)
+
+    def tearDown(self):
+        self.server.close()
+
+    # The fake GTV server records the requests and answers like a Quake 3 server to an rcon command
+    def answer(self, fd):
+        data, address = self.server.recvfrom(65536)
+        self.packets.append(data)
+        self.server.sendto('\xff\xff\xff\xffprint\n', address)
+
+    # The heartbeat request arrives at the first beat (after min(interval, 10) seconds), and the answer is read by the eventloop
+    def test_heartbeat_arrives(self):
+        heartbeater = rotator.Heartbeater(self.eventloop, interval=1)
+        heartbeater.add_server('127.0.0.1', self.server.getsockname()[1], 'pw')
+        self.eventloop.run_until(time.time() + 1.5)
+        heartbeater.socket.close()
+        self.assertEqual(self.packets, ['\xff\xff\xff\xffrcon "pw" heartbeat\n'])
+
+    # A server listed twice is only asked once per beat
+    def test_one_request_per_server(self):
+        heartbeater = rotator.Heartbeater(self.eventloop, interval=60)
+        heartbeater.add_server('127.0.0.1', self.server.getsockname()[1], 'pw')
+        heartbeater.add_server('127.0.0.1', str(self.server.getsockname()[1]), 'pw')
+        heartbeater.beat()
+        self.eventloop.run_until(time.time() + 0.5)
+        heartbeater.socket.close()
+        self.assertEqual(len(self.packets), 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,44 @@
+# Tests of the history of the match ends (MatchHistory)
+import os, shutil, tempfile, unittest
+import helpers
+
+rotator = None
+
+def setUpModule():
+    global rotator
+    rotator = helpers.load_rotator()
+
+class MatchHistoryTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.history = rotator.MatchHistory(os.path.join(self.folder, 'history.json'), maximum=600, binsize=15, percentile=90, minsamples=10)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    # The old samples decay: once the matches are short again, so is the margin
+    def test_margin_comes_back_down(self):
+        for i in range(20):
+            self.history.record('baseoa/4', 500)
+        self.assertEqual(self.history.margin('baseoa/4'), 510)
+        for i in range(60):
+            self.history.record('baseoa/4', 40)
+        self.assertEqual(self.history.margin('baseoa/4'), 45)
+
+    # A match cut at the cap is only known to end later, not at the maximum margin
+    def test_censored_matches_grow_the_margin_one_bin_at_a_time(self):
+        for i in range(20):
+            self.history.record('baseoa/4', 100, censored=True) # cut at 100 seconds, in the bin 90-105
+        self.assertEqual(self.history.margin('baseoa/4'), 120)
+
+    def test_history_is_saved(self):
+        for i in range(10):
+            self.history.record('baseoa/4', 40)
+        self.history.record('baseoa/4', 100, censored=True)
+        history = rotator.MatchHistory(self.history.path, maximum=600, binsize=15, percentile=90, minsamples=10)
+        self.assertEqual(history.histograms, self.history.histograms)
+        self.assertEqual(history.censored, self.history.censored)
+        self.assertEqual(history.margin('baseoa/4'), self.history.margin('baseoa/4'))
+
+if __name__ == '__main__':
+    unittest.main()